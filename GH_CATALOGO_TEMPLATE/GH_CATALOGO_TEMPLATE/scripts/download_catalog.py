@@ -1,14 +1,51 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import os, re, sys, zipfile
+import logging, logging.handlers, os, re, sys, zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import requests, pandas as pd
-
-def sanitize(s):
-    if s is None: return ""
-    s = str(s).strip()
-    s = re.sub(r'[\\/:*?"<>|]+', "-", s)
-    return s
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+MAX_WORKERS = 32  # descargas simultáneas (I/O-bound, la red libera el GIL)
+_RE_BAD = re.compile(r'[\\/:*?"<>|]+')
+log = logging.getLogger("dl")
+NO_COMPRESS = {".jpg", ".jpeg", ".pdf", ".png", ".webp", ".gif"}  # ya comprimidos: ZIP_STORED
+
+def setup_logging():
+    """Un solo handler a stdout, con buffer: vuelca cada 500 líneas (o ante un error), no en cada fila."""
+    out = logging.StreamHandler(sys.stdout)
+    out.setFormatter(logging.Formatter("%(message)s"))
+    buf = logging.handlers.MemoryHandler(capacity=500, flushLevel=logging.ERROR, target=out)
+    log.addHandler(buf)
+    log.setLevel(logging.INFO)
+    log.propagate = False
+
+def sanitize_col(col, clean=True):
+    """Columna entera a texto limpio de una vez (vectorizado): vacíos a "", strip y, si clean,
+    caracteres no válidos en nombres de fichero a "-"."""
+    s = col.fillna("").astype(str).str.strip()
+    if clean:
+        s = s.str.replace(_RE_BAD, "-", regex=True)
+    return s.to_numpy()
+
+# firmas de fichero: mandan los primeros bytes, no el Content-Type ni la extensión de la URL
+PDF_MAGIC = b"%PDF-"
+IMAGE_MAGICS = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n", b"GIF87a", b"GIF89a", b"BM", b"II*\x00", b"MM\x00*")
+
+def looks_like_pdf(head: bytes) -> bool:
+    return PDF_MAGIC in head[:1024]  # la especificación admite basura antes de la cabecera en el primer KiB
+
+def looks_like_image(head: bytes) -> bool:
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return True
+    return head.startswith(IMAGE_MAGICS)
+
+SNIFF = {"IMG": (looks_like_image, "not an image"), "PDF": (looks_like_pdf, "not a PDF")}
+
+def part_path(dest: Path) -> Path:
+    """Se escribe aquí y se publica con os.replace: un corte a mitad no deja un fichero final a medias."""
+    return dest.with_name(dest.name + ".part")
 
 def ensure_parent(p: Path):
     p.parent.mkdir(parents=True, exist_ok=True)
@@ -23,36 +60,68 @@ def ext_from_ct(ct):
     if "webp" in ct: return ".webp"
     return None
 
-def download(url, dest: Path, session, force_jpg=False):
+def download(url, dest: Path, session, kind, force_jpg=False):
+    """kind "IMG"/"PDF": los primeros bytes se comprueban antes de crear nada en disco (una página de
+    error HTML servida bajo una URL .pdf no acaba en FICHAS/ como .pdf). Se descarga a <dest>.part."""
+    sniff, reject = SNIFF[kind]
+    part = None
     try:
         with session.get(url, timeout=45, stream=True) as r:
             if r.status_code != 200:
                 return False, f"HTTP {r.status_code}"
+            chunks = r.iter_content(8192)
+            head = b""
+            for chunk in chunks:  # hasta 1 KiB: un primer trozo puede venir más corto que la firma
+                head += chunk
+                if len(head) >= 1024:
+                    break
+            if not sniff(head):
+                return False, reject
             ct = r.headers.get("Content-Type", "")
             ext = ext_from_ct(ct)
             if ext: dest = dest.with_suffix(ext)
             ensure_parent(dest)
-            with open(dest, "wb") as f:
-                for chunk in r.iter_content(8192):
+            part = part_path(dest)
+            with open(part, "wb") as f:
+                f.write(head)
+                for chunk in chunks:
                     if chunk: f.write(chunk)
+        os.replace(part, dest)
         if force_jpg and "image" in (ct or "").lower() and dest.suffix.lower() not in (".jpg",".jpeg"):
+            jpg = dest.with_suffix(".jpg")
             try:
                 from PIL import Image
-                img = Image.open(dest).convert("RGB")
-                jpg = dest.with_suffix(".jpg")
-                img.save(jpg, "JPEG", quality=92, optimize=True)
+                with Image.open(dest) as im:
+                    im.convert("RGB").save(part_path(jpg), "JPEG", quality=85, progressive=True, subsampling=2, optimize=False)
+                os.replace(part_path(jpg), jpg)
                 dest.unlink(missing_ok=True)
             except Exception:
-                pass
+                part_path(jpg).unlink(missing_ok=True)
         return True, "OK"
     except Exception as e:
+        if part is not None:
+            part.unlink(missing_ok=True)
         return False, str(e)
 
+def link_tree(src_root: Path, dst_root: Path):
+    """Réplica de src_root en dst_root con hardlinks (sin duplicar bytes); copia si cruza de dispositivo."""
+    import shutil
+    for src in src_root.rglob("*"):
+        if not src.is_file() or src.suffix == ".part":  # parciales de una ejecución cortada: fuera
+            continue
+        dst = dst_root / src.relative_to(src_root)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
 def main():
     import argparse
     ap = argparse.ArgumentParser()
     ap.add_argument("--excel", default="data/RESUMEN_CATALOGO.xlsx", help="Ruta al Excel con URLs")
     args = ap.parse_args()
+    setup_logging()
 
     EXCEL_PATH = args.excel
     OUTPUT_ROOT = Path("CATALOGO")
@@ -69,68 +138,82 @@ def main():
         # fallback al template si el archivo con ese nombre no existe
         EXCEL_PATH = "data/RESUMEN_CATALOGO_TEMPLATE.xlsx"
         if not os.path.exists(EXCEL_PATH):
-            print(f"[ERROR] No existe {args.excel} ni el template por defecto.")
+            log.error(f"[ERROR] No existe {args.excel} ni el template por defecto.")
             sys.exit(1)
 
     df = pd.read_excel(EXCEL_PATH, sheet_name=0)
     for c in [COL_COD_ART, COL_REF_PROV, COL_PROVEEDOR, COL_COD_PROV, COL_URL_IMG, COL_URL_FICHA]:
         if c not in df.columns:
-            print(f"[ERROR] Falta columna: {c}")
+            log.error(f"[ERROR] Falta columna: {c}")
             sys.exit(1)
 
     s = requests.Session()
-    s.headers.update({"User-Agent":"Mozilla/5.0"})
+    s.headers.update({"User-Agent":"Mozilla/5.0", "Accept-Encoding":"gzip, deflate"})
+    # pool keep-alive >= MAX_WORKERS (el de por defecto es 10) + reintentos ante 429/5xx
+    adapter = HTTPAdapter(pool_connections=64, pool_maxsize=64,
+                          max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429,500,502,503,504]))
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
 
     total = len(df)
     with_url = 0
+    jobs = []  # (etiqueta, base, url, destino, force_jpg)
+    queued = set()  # un destino solo se encola una vez (dos hilos no deben escribir el mismo fichero)
 
-    for i, row in df.iterrows():
-        cod_art = sanitize(row.get(COL_COD_ART,""))
-        ref_prov = sanitize(row.get(COL_REF_PROV,""))
-        proveedor = sanitize(row.get(COL_PROVEEDOR,""))
-        cod_prov = sanitize(row.get(COL_COD_PROV,""))
-        uimg = str(row.get(COL_URL_IMG,"") or "").strip()
-        updf = str(row.get(COL_URL_FICHA,"") or "").strip()
+    # columnas preparadas antes del bucle: nada de iterrows() + row.get por celda
+    cols = zip(sanitize_col(df[COL_COD_ART]), sanitize_col(df[COL_REF_PROV]),
+               sanitize_col(df[COL_PROVEEDOR]), sanitize_col(df[COL_COD_PROV]),
+               sanitize_col(df[COL_URL_IMG], clean=False), sanitize_col(df[COL_URL_FICHA], clean=False))
+    for i, (cod_art, ref_prov, proveedor, cod_prov, uimg, updf) in enumerate(cols):
 
         if not cod_art or not ref_prov or not proveedor or not cod_prov:
-            print(f"[{i+1}/{total}] SKIP: faltan campos clave")
+            log.info(f"[{i+1}/{total}] SKIP: faltan campos clave")
             continue
 
         base = f"{cod_art} - {ref_prov}"
         img_dir = OUTPUT_ROOT / "IMAGENES" / f"{cod_prov} - {proveedor}"
         pdf_dir = OUTPUT_ROOT / "FICHAS" / f"{cod_prov} - {proveedor}"
 
-        if uimg:
-            ok, msg = download(uimg, img_dir / (base + ".jpg"), s, force_jpg=True)
-            print(f"[IMG] {base}: {msg}")
+        if uimg and img_dir / (base + ".jpg") not in queued:
+            jobs.append(("IMG", base, uimg, img_dir / (base + ".jpg"), True))
+            queued.add(img_dir / (base + ".jpg"))
             with_url += 1
-        if updf:
-            ok, msg = download(updf, pdf_dir / (base + ".pdf"), s, force_jpg=False)
-            # seguridad: solo mantener si es PDF real; si no, borrar
-            if not str((pdf_dir / (base + '.pdf'))).lower().endswith(".pdf"):
-                pass
-            print(f"[PDF] {base}: {msg}")
+        if updf and pdf_dir / (base + ".pdf") not in queued:
+            jobs.append(("PDF", base, updf, pdf_dir / (base + ".pdf"), False))
+            queued.add(pdf_dir / (base + ".pdf"))
             with_url += 1
 
+    # descargas en paralelo; el ZIP espera a que termine el pool
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        futures = {ex.submit(download, url, dest, s, tag, force_jpg=fj): (tag, base)
+                   for tag, base, url, dest, fj in jobs}
+        for fut in as_completed(futures):
+            tag, base = futures[fut]
+            ok, msg = fut.result()
+            log.info(f"[{tag}] {base}: {msg}")
+
     # zip
-    with zipfile.ZipFile(ZIP_NAME, "w", zipfile.ZIP_DEFLATED) as z:
-        for folder, _, files in os.walk(OUTPUT_ROOT):
-            for f in files:
-                full = os.path.join(folder, f)
-                arc = os.path.relpath(full, start=os.path.dirname(OUTPUT_ROOT))
-                z.write(full, arc)
+    root_parent = OUTPUT_ROOT.parent  # relative_to es un recorte de ruta; relpath hace abspath + split por fichero
+    with zipfile.ZipFile(ZIP_NAME, "w", zipfile.ZIP_DEFLATED, compresslevel=6) as z:
+        for p in OUTPUT_ROOT.rglob("*"):
+            if p.is_file() and p.suffix != ".part":
+                method = zipfile.ZIP_STORED if p.suffix.lower() in NO_COMPRESS else zipfile.ZIP_DEFLATED
+                z.write(p, p.relative_to(root_parent), compress_type=method)
 
     # write output/ tree for browsing in repo
     out_dir = Path("output")
     out_dir.mkdir(exist_ok=True)
     if out_dir.exists():
-        # copy tree
+        # hardlink tree (mismo contenido que CATALOGO/, sin copiar cada fichero)
         import shutil
         if (out_dir / "CATALOGO").exists():
             shutil.rmtree(out_dir / "CATALOGO")
-        shutil.copytree(OUTPUT_ROOT, out_dir / "CATALOGO")
+        link_tree(OUTPUT_ROOT, out_dir / "CATALOGO")
 
-    print(f"[OK] Proceso completado. Total filas: {total}. Descargas con URL: {with_url}.")
+    log.info(f"[OK] Proceso completado. Total filas: {total}. Descargas con URL: {with_url}.")
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        logging.shutdown()  # vacía el buffer pendiente
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Definiciones compartidas por enrich_urls.py y download_catalog.py: nombres de columnas del
+Excel, regla de exclusión de proveedores y normalización de texto. Un único sitio para que
+un cambio (p.ej. una columna renombrada) no tenga que replicarse en cada script.
+"""
+
+import math
+import re
+import unicodedata
+from functools import lru_cache
+
+import pandas as pd
+
+# Nombres de columnas
+COLS = {
+    "cod_art": "Cód. Articulo Naves",
+    "refprov": "Referencia Proveedor",
+    "art":     "Artículo",
+    "prov":    "Proveedor",
+    "codprov": "Cód. Proveedor",
+    "img":     "URL Imagen Oficial",
+    "pdf":     "URL Ficha Técnica Oficial",
+}
+
+# Proveedores a excluir (se comparan normalizados, por subcadena)
+EXCLUDE_PROVIDERS = frozenset({"FAMARA"})
+
+_RE_ALNUM = re.compile(r"[^A-Z0-9]+")
+
+
+@lru_cache(maxsize=4096)  # los proveedores se repiten mucho entre filas
+def norm_text(s: str) -> str:
+    s = str(s or "").upper()
+    if s.isascii():  # caso habitual: sin acentos no hay nada que descomponer
+        return _RE_ALNUM.sub(" ", s).strip()
+    s = unicodedata.normalize("NFKD", s)
+    return _RE_ALNUM.sub(" ", "".join(ch for ch in s if not unicodedata.combining(ch))).strip()
+
+
+EXCLUDE_NORM = frozenset(map(norm_text, EXCLUDE_PROVIDERS))
+# una sola búsqueda por proveedor en vez de un `any(... in ...)` sobre EXCLUDE_NORM
+# (sin proveedores excluidos, un patrón que nunca casa: "" casaría con todo)
+EXCLUDE_RE = re.compile("|".join(re.escape(w) for w in sorted(EXCLUDE_NORM)) or r"(?!)")
+
+
+def is_empty(val) -> bool:
+    if val is None:
+        return True
+    if isinstance(val, float) and (math.isnan(val) or math.isinf(val)):
+        return True
+    s = str(val).strip()
+    return s == "" or s.lower() == "nan" or s == "None"
+
+
+def excel_read_engine() -> str:
+    """python-calamine (parser xlsx en Rust) si está instalado; si no, openpyxl."""
+    try:
+        import python_calamine  # noqa: F401
+        return "calamine"
+    except ImportError:
+        return "openpyxl"
+
+
+def empty_mask(col: pd.Series) -> pd.Series:
+    """is_empty() aplicado a una columna entera (vectorizado): una pasada en pandas, no una llamada por celda."""
+    s = col.astype("string").str.strip()
+    return col.isna() | s.isna() | s.isin(["", "None"]) | (s.str.lower() == "nan")
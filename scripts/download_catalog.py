@@ -14,64 +14,80 @@ Descarga imágenes (→ .jpg) y fichas técnicas (.pdf) desde el Excel enriqueci
 
 Requisitos:
   pip install requests pandas openpyxl pillow
+  (opcional) pip install python-calamine  → lectura del Excel 5-10× más rápida
+  (opcional) jpegoptim en el PATH para recomprimir los JPEG que se guardan tal cual
+  (opcional) pip install --force-reinstall pillow-simd  → DCT con SIMD (requiere libjpeg-turbo)
 """
 
 import argparse
-import io
-import math
+import hashlib
+import itertools
+import json
+import multiprocessing
 import mimetypes
 import os
 import re
-import unicodedata
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from zipfile import ZipFile, ZIP_DEFLATED
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 
 import pandas as pd
 import requests
 from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from catalog_common import COLS, EXCLUDE_RE, empty_mask, excel_read_engine, norm_text
 
-# -------------------- Config --------------------
-
-COLS = {
-    "cod_art": "Cód. Articulo Naves",
-    "refprov": "Referencia Proveedor",
-    "art":     "Artículo",
-    "prov":    "Proveedor",
-    "codprov": "Cód. Proveedor",
-    "img":     "URL Imagen Oficial",
-    "pdf":     "URL Ficha Técnica Oficial",
-}
 
-EXCLUDE_PROVIDERS = {"FAMARA"}  # normalizado
+# -------------------- Config --------------------
 
 DEFAULT_OUT_DIR = "CATALOGO"
 DEFAULT_ZIP     = "CATALOGO.zip"
+DEFAULT_STATE   = "data/.download_state.json"  # URL → {etag, last_modified, dest, sha256}
+
+DEFAULT_WORKERS = 32  # descargas simultáneas (I/O-bound: las esperas de red liberan el GIL)
+POOL_SIZE       = 64  # conexiones keep-alive por host (mínimo; crece con --workers)
+
+MAX_IMG_EDGE = 1600             # lado mayor (px) de la imagen final; por debajo, un JPEG se guarda tal cual
+MAX_PASSTHROUGH_BYTES = 1 << 20  # ...si además no pasa de 1 MiB (si pesa más, se recodifica para aligerarlo)
+JPEG_MAGIC   = b"\xff\xd8\xff"
+PDF_MAGIC    = b"%PDF-"
+# Firmas de imagen admitidas (los primeros bytes mandan, no el Content-Type ni la extensión)
+IMAGE_MAGICS = (JPEG_MAGIC, b"\x89PNG\r\n\x1a\n", b"GIF87a", b"GIF89a", b"BM", b"II*\x00", b"MM\x00*")
+JPEGOPTIM    = shutil.which("jpegoptim")
+
+CHUNK_SIZE = 1 << 20  # 1 MiB por write()
+
+# Formatos ya comprimidos: deflate gasta CPU para ~0% de ahorro
+NO_COMPRESS = {".jpg", ".jpeg", ".pdf", ".png", ".webp"}
+
+_RE_BAD    = re.compile(r"[\\/:*?\"<>|]+")
+_RE_WS     = re.compile(r"\s+")
+_RE_CONTENT_RANGE = re.compile(r"bytes (\d+)-")  # inicio del tramo de un 206
 
 
 # -------------------- Utilidades --------------------
 
-def norm_text(s: str) -> str:
-    s = str(s or "").strip().upper()
-    s = unicodedata.normalize("NFKD", s)
-    s = "".join(ch for ch in s if not unicodedata.combining(ch))
-    return re.sub(r"[^A-Z0-9]+", " ", s).strip()
+def read_catalog(path: Path) -> pd.DataFrame:
+    """Lee solo las columnas de COLS, como texto (sin inferencia de tipos en el resto)."""
+    wanted = set(COLS.values())
+    return pd.read_excel(path, sheet_name=0, engine=excel_read_engine(),
+                         usecols=lambda c: c in wanted, dtype={c: "string" for c in wanted})
 
 
-def is_empty(val) -> bool:
-    if val is None:
-        return True
-    if isinstance(val, float) and (math.isnan(val) or math.isinf(val)):
-        return True
-    s = str(val).strip()
-    return s == "" or s.lower() == "nan" or s == "None"
+def clean_col(col: pd.Series) -> pd.Series:
+    """`str(...).strip()` de una columna entera, con las celdas vacías (empty_mask) a ""."""
+    return col.astype(str).str.strip().where(~empty_mask(col), "")
 
 
 def safe_name(s: str) -> str:
     # Mantiene letras, números, guiones y espacios; colapsa repeticiones
     s = str(s or "").strip()
-    s = re.sub(r"[\\/:*?\"<>|]+", " ", s)
-    s = re.sub(r"\s+", " ", s)
+    s = _RE_BAD.sub(" ", s)
+    s = _RE_WS.sub(" ", s)
     return s
 
 
@@ -79,66 +95,292 @@ def ensure_dir(p: Path):
     p.mkdir(parents=True, exist_ok=True)
 
 
-def is_pdf_content_type(ct: str) -> bool:
-    return ct and "application/pdf" in ct.lower()
+def looks_like_pdf(head: bytes) -> bool:
+    # La especificación admite basura antes de la cabecera dentro del primer KiB
+    return PDF_MAGIC in head[:1024]
+
+
+def looks_like_image(head: bytes) -> bool:
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return True
+    return head.startswith(IMAGE_MAGICS)
+
+
+def make_session(pool_size: int = POOL_SIZE) -> requests.Session:
+    """
+    Session con pool de conexiones grande y reintentos: reutiliza TCP+TLS entre filas
+    y evita "Connection pool is full, discarding connection" con el pool de hilos.
+    """
+    s = requests.Session()
+    s.headers.update({"User-Agent": "Mozilla/5.0", "Accept-Encoding": "gzip, deflate"})
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
+
+
+def load_state(path: Path) -> dict:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(path: Path, state: dict):
+    ensure_dir(path.parent)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=1, sort_keys=True)
+
+
+def file_sha256(path: Path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def conditional_headers(state: dict, url: str, dest: Path) -> dict:
+    """
+    If-None-Match / If-Modified-Since de la última descarga, solo si esa descarga se publicó en `dest`
+    y el fichero sigue intacto (mismo sha256): un 304 deja `dest` como está, así que tiene que ser
+    el de esta URL y no el de otra que la fila tenía antes.
+    """
+    prev = state.get(url) if state is not None else None
+    if not prev or prev.get("dest") != str(dest) or not dest.exists():
+        return {}
+    try:
+        if file_sha256(dest) != prev.get("sha256"):
+            return {}
+    except OSError:
+        return {}
+    headers = {}
+    if prev.get("etag"):
+        headers["If-None-Match"] = prev["etag"]
+    if prev.get("last_modified"):
+        headers["If-Modified-Since"] = prev["last_modified"]
+    return headers
+
+
+def remember(state: dict, url: str, r: requests.Response, dest: Path, sha256: str = None):
+    """Validadores de `r` y el fichero publicado en `dest` (sha256 del .jpg final, no de lo descargado)."""
+    if state is not None:
+        state[url] = {"etag": r.headers.get("ETag", ""),
+                      "last_modified": r.headers.get("Last-Modified", ""),
+                      "dest": str(dest), "sha256": sha256 or file_sha256(dest)}
 
 
-def is_image_content_type(ct: str) -> bool:
-    return ct and ct.lower().startswith("image/")
+def copy_hashed(chunks, f, h=None) -> str:
+    """Escribe los bloques en f y devuelve el sha256 (continuando `h` si se pasa)."""
+    h = h or hashlib.sha256()
+    for chunk in chunks:
+        if chunk:
+            h.update(chunk)
+            f.write(chunk)
+    return h.hexdigest()
 
 
-def fetch(session: requests.Session, url: str, stream: bool = True, timeout: int = 30) -> requests.Response:
-    r = session.get(url, stream=stream, timeout=timeout, allow_redirects=True)
+def part_path(dest: Path) -> Path:
+    return dest.with_name(dest.name + ".part")
+
+
+def part_meta_path(dest: Path) -> Path:
+    """URL y validador del .part a medias (también acaba en .part: fuera del ZIP)."""
+    return dest.with_name(dest.name + ".meta.part")
+
+
+def discard_part(dest: Path):
+    part_path(dest).unlink(missing_ok=True)
+    part_meta_path(dest).unlink(missing_ok=True)
+
+
+def resume_validator(dest: Path, url: str) -> str:
+    """
+    Valor de If-Range para reanudar el .part de `dest`: ETag fuerte o Last-Modified de la respuesta
+    con la que se empezó. "" si el .part es de otra URL o no hay validador (no se puede reanudar).
+    """
+    try:
+        meta = json.loads(part_meta_path(dest).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return ""
+    if meta.get("url") != url:
+        return ""
+    etag = meta.get("etag", "")
+    if etag and not etag.startswith("W/"):  # If-Range no admite ETags débiles
+        return etag
+    return meta.get("last_modified", "")
+
+
+def save_part_meta(dest: Path, url: str, r: requests.Response):
+    part_meta_path(dest).write_text(json.dumps({
+        "url": url, "etag": r.headers.get("ETag", ""),
+        "last_modified": r.headers.get("Last-Modified", "")}), encoding="utf-8")
+
+
+def fetch(session: requests.Session, url: str, stream: bool = True, timeout: int = 30,
+          headers: dict = None) -> requests.Response:
+    r = session.get(url, stream=stream, timeout=timeout, allow_redirects=True, headers=headers)
     r.raise_for_status()
     return r
 
 
-def download_pdf(session: requests.Session, url: str, dest: Path) -> bool:
+def optimize_jpeg(path: Path):
+    """Recompresión casi sin pérdida con jpegoptim, si está instalado (si no, no hace nada)."""
+    if JPEGOPTIM:
+        subprocess.run([JPEGOPTIM, "--strip-all", "--quiet", "-m90", str(path)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+
+
+def download_to_part(session: requests.Session, url: str, dest: Path, sniff, state: dict = None):
+    """
+    Descarga `url` en `<dest>.part` (nunca directamente en `dest`: un proceso cortado no deja un
+    fichero final corrupto). Si hay un .part de una ejecución anterior de la misma URL, se reanuda
+    con Range + If-Range: si el recurso cambió, el servidor manda el fichero entero y se empieza de cero.
+    Devuelve (respuesta, sha256); sha256 es None si es un 304 o si `sniff` rechaza los primeros bytes.
+    """
+    part = part_path(dest)
+    offset = part.stat().st_size if part.exists() else 0
+    validator = resume_validator(dest, url) if offset else ""
+    if offset and not validator:  # de otra URL (el .part va por `dest`) o sin validador: no se empalma
+        discard_part(dest)
+        offset = 0
+    if offset:
+        # Range cuenta bytes de la representación sin comprimir: se pide identity
+        headers = {"Range": f"bytes={offset}-", "If-Range": validator, "Accept-Encoding": "identity"}
+    else:
+        headers = conditional_headers(state, url, dest)
+    try:
+        r = fetch(session, url, stream=True, headers=headers)
+    except requests.HTTPError:
+        discard_part(dest)  # p.ej. 416: el parcial no sirve, la próxima vez desde cero
+        raise
+    if r.status_code == 304:  # sin cambios desde la última descarga
+        return r, None
+
+    if offset and r.status_code == 206:
+        m = _RE_CONTENT_RANGE.match(r.headers.get("Content-Range", ""))
+        if not m or int(m.group(1)) != offset:  # el tramo no empieza donde acaba el .part
+            r.close()
+            discard_part(dest)
+            return download_to_part(session, url, dest, sniff, state)
+
+    r.raw.decode_content = True
+    chunks = iter(lambda: r.raw.read(CHUNK_SIZE), b"")
+    h = hashlib.sha256()
+    if offset and r.status_code == 206:
+        mode = "ab"
+        with open(part, "rb") as f:
+            for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+                h.update(block)
+    else:
+        # Descarga completa: se valida la firma del primer bloque antes de crear nada en disco
+        discard_part(dest)
+        first = next(chunks, b"")
+        if not sniff(first):
+            r.close()
+            return r, None
+        chunks = itertools.chain([first], chunks)
+        mode = "wb"
+        save_part_meta(dest, url, r)  # antes del primer byte: un corte deja .part y meta a la par
+    with open(part, mode) as f:
+        sha = copy_hashed(chunks, f, h)
+    part_meta_path(dest).unlink(missing_ok=True)  # completo: ya no hay nada que reanudar
+    return r, sha
+
+
+def download_pdf(session: requests.Session, url: str, dest: Path, state: dict = None) -> bool:
     try:
-        r = fetch(session, url, stream=True)
-        ct = r.headers.get("Content-Type", "").lower()
-        # Si el servidor no pone bien el CT pero la URL acaba en .pdf, aceptamos igualmente
-        if not (is_pdf_content_type(ct) or url.lower().endswith(".pdf")):
+        # %PDF- en el primer KiB: una página de error HTML servida bajo una URL .pdf no deja basura
+        r, sha = download_to_part(session, url, dest, looks_like_pdf, state)
+        if r.status_code == 304:
+            return True
+        if sha is None:
             return False
-        with open(dest, "wb") as f:
-            for chunk in r.iter_content(65536):
-                if chunk:
-                    f.write(chunk)
+        os.replace(part_path(dest), dest)
+        remember(state, url, r, dest, sha)
         return True
     except Exception:
         return False
 
 
-def download_image_as_jpg(session: requests.Session, url: str, dest_jpg: Path) -> bool:
+def fetch_image(session: requests.Session, url: str, dest_jpg: Path, state: dict = None):
     """
-    Descarga imagen (cualquier formato) y la convierte a JPG.
+    Parte de red de la descarga de una imagen (corre en el pool de hilos de I/O).
+    Devuelve True si la imagen ya está en su sitio (304 o JPEG guardado tal cual), False si falla,
+    o (ruta del .part, respuesta) cuando hay que recodificarla con encode_jpg (pool de procesos);
+    en ese caso la URL se apunta en `state` solo cuando la recodificación sale bien.
     """
     try:
-        r = fetch(session, url, stream=True)
-        ct = r.headers.get("Content-Type", "").lower()
-        # Aceptamos si el CT es image/* o si la URL parece imagen por extensión conocida
-        if not (is_image_content_type(ct) or re.search(r"\.(png|jpg|jpeg|webp|bmp|gif|tif|tiff)$", url, re.I)):
+        # Aceptamos solo si los primeros bytes son de una imagen conocida (JPEG/PNG/GIF/WebP/BMP/TIFF)
+        r, sha = download_to_part(session, url, dest_jpg, looks_like_image, state)
+        if r.status_code == 304:
+            return True
+        if sha is None:
+            return False
+
+        part = part_path(dest_jpg)
+        try:
+            # JPEG de tamaño razonable (bytes y píxeles): copia de bytes, sin decodificar ni recodificar.
+            # El tamaño sale del propio fichero descargado: no hace falta un HEAD previo.
+            if part.stat().st_size > MAX_PASSTHROUGH_BYTES:
+                passthrough = False
+            else:
+                with Image.open(part) as im:  # perezoso: solo lee la cabecera
+                    passthrough = im.format == "JPEG" and im.mode in ("RGB", "L") and max(im.size) <= MAX_IMG_EDGE
+        except Exception:
+            part.unlink(missing_ok=True)
             return False
+        if not passthrough:
+            return part, r
+        os.replace(part, dest_jpg)
+        optimize_jpeg(dest_jpg)  # reescribe el fichero: el sha256 se calcula después
+        remember(state, url, r, dest_jpg)
+        return True
+    except Exception:
+        return False
 
-        data = io.BytesIO(r.content)
-        im = Image.open(data)
-        # Convertir a RGB si es RGBA/L o similar
-        if im.mode not in ("RGB", "L"):
-            im = im.convert("RGB")
-        elif im.mode == "L":
-            im = im.convert("RGB")
-        ensure_dir(dest_jpg.parent)
-        im.save(dest_jpg, format="JPEG", quality=90, optimize=True)
+
+def encode_jpg(part: Path, dest_jpg: Path) -> bool:
+    """
+    Recodifica a JPG la imagen descargada en `part` (CPU: corre en el pool de procesos, fuera del GIL
+    de los hilos de descarga). Borra `part` al terminar, con o sin éxito.
+    """
+    tmp = dest_jpg.with_name(dest_jpg.name + ".enc.part")
+    try:
+        with Image.open(part) as im:
+            # PNG/WebP/..., CMYK o JPEG enorme: en JPEG, libjpeg decodifica ya a escala reducida
+            im.draft("RGB", (MAX_IMG_EDGE, MAX_IMG_EDGE))
+            # Convertir a RGB si es RGBA/L o similar
+            out = im.convert("RGB") if im.mode != "RGB" else im
+            out.thumbnail((MAX_IMG_EDGE, MAX_IMG_EDGE), Image.Resampling.LANCZOS)
+            # sin optimize (pasada Huffman extra: ~2× tiempo por <3% de tamaño); 4:2:0 para fotos de catálogo
+            # a un temporal y os.replace: un corte a mitad no deja un .jpg truncado que el siguiente run
+            # daría por bueno, ni se escribe a través de los hardlinks de ese inodo (link_or_copy).
+            # Acaba en .part (fuera del ZIP) y no choca con `part`, que aún se está leyendo
+            out.save(tmp, format="JPEG", quality=85, progressive=True, subsampling=2, optimize=False)
+        os.replace(tmp, dest_jpg)
         return True
     except Exception:
         return False
+    finally:
+        tmp.unlink(missing_ok=True)
+        part.unlink(missing_ok=True)  # ya descargado entero: no hay nada que reanudar
+
+
+def link_or_copy(src: Path, dst: Path):
+    """Hardlink (sin duplicar bytes en disco); copia si el sistema de ficheros no lo permite."""
+    dst.unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
 
 
 def zip_dir(root_dir: Path, zip_path: Path):
-    with ZipFile(zip_path, "w", ZIP_DEFLATED) as zf:
+    with ZipFile(zip_path, "w", ZIP_DEFLATED, compresslevel=6) as zf:
         for p in root_dir.rglob("*"):
-            if p.is_file():
-                zf.write(p, p.relative_to(root_dir))
+            if p.is_file() and p.suffix != ".part":  # parciales de descargas cortadas: fuera del ZIP
+                method = ZIP_STORED if p.suffix.lower() in NO_COMPRESS else ZIP_DEFLATED
+                zf.write(p, p.relative_to(root_dir), compress_type=method)
 
 
 # -------------------- Main --------------------
@@ -154,19 +396,24 @@ def main():
     ap.add_argument("--provider-contains", default="",
                     help='Descargar SOLO filas cuyo "Proveedor" contenga este texto (normalizado). Vacío = todas')
     ap.add_argument("--overwrite", action="store_true",
-                    help="Sobrescribir ficheros existentes (por defecto no)")
+                    help="Volver a pedir ficheros existentes (GET condicional: un 304 no reescribe nada)")
+    ap.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                    help=f"Descargas simultáneas (por defecto: {DEFAULT_WORKERS})")
+    ap.add_argument("--state", default=DEFAULT_STATE,
+                    help=f"JSON con ETag/Last-Modified de cada URL descargada (por defecto: {DEFAULT_STATE})")
     args = ap.parse_args()
 
     excel_path = Path(args.excel)
     out_root   = Path(args.out_dir)
     zip_path   = Path(args.zip_name)
+    state_path = Path(args.state)
     prov_filter = norm_text(args.provider_contains)
 
     if not excel_path.exists():
         print(f"[ERROR] Excel no encontrado: {excel_path}")
         raise SystemExit(1)
 
-    df = pd.read_excel(excel_path, sheet_name=0)
+    df = read_catalog(excel_path)
 
     # Comprobar columnas
     for key in COLS.values():
@@ -174,8 +421,9 @@ def main():
             print(f"[ERROR] Falta columna en el Excel: '{key}'")
             raise SystemExit(1)
 
-    s = requests.Session()
-    s.headers.update({"User-Agent": "Mozilla/5.0"})
+    workers = max(1, args.workers)
+    s = make_session(max(POOL_SIZE, workers))
+    state = load_state(state_path)
 
     ensure_dir(out_root)
     imgs_root  = out_root / "IMAGENES"
@@ -186,22 +434,34 @@ def main():
     total = len(df)
     stats = {"rows": total, "skipped_excluded": 0, "skipped_provider": 0,
              "img_ok": 0, "img_skip": 0, "pdf_ok": 0, "pdf_skip": 0}
-
-    for i, row in df.iterrows():
-        cod_art  = row[COLS["cod_art"]]
-        refprov  = str(row[COLS["refprov"]] if not is_empty(row[COLS["refprov"]]) else "").strip()
-        prov     = str(row[COLS["prov"]] if not is_empty(row[COLS["prov"]]) else "").strip()
-        codprov  = str(row[COLS["codprov"]] if not is_empty(row[COLS["codprov"]]) else "").strip()
-        url_img  = str(row[COLS["img"]] if not is_empty(row[COLS["img"]]) else "").strip()
-        url_pdf  = str(row[COLS["pdf"]] if not is_empty(row[COLS["pdf"]]) else "").strip()
+    jobs = {}        # (tipo, url) → [destinos]; cada URL distinta se descarga una sola vez
+    on_disk = {}     # (tipo, url) → un destino que ya existe (sirve de origen sin tocar la red)
+    queued = set()   # destinos ya encolados (evita dos hilos escribiendo el mismo fichero)
+    folders = set()  # carpetas de fabricante: un mkdir por proveedor, no por fila
+
+    # Limpieza y normalización por columna (no por fila); norm_text corre una vez por proveedor distinto
+    for c in COLS.values():
+        df[c] = clean_col(df[c])
+    # Una vista de objetos Python por columna, indexada por posición (sin indexadores de pandas por celda)
+    arr_art     = df[COLS["cod_art"]].to_numpy()
+    arr_ref     = df[COLS["refprov"]].to_numpy()
+    arr_prov    = df[COLS["prov"]].to_numpy()
+    arr_codprov = df[COLS["codprov"]].to_numpy()
+    arr_img     = df[COLS["img"]].to_numpy()
+    arr_pdf     = df[COLS["pdf"]].to_numpy()
+    arr_norm    = df[COLS["prov"]].astype("category").map(norm_text).to_numpy()
+
+    for i in range(total):
+        cod_art, refprov, prov, codprov = arr_art[i], arr_ref[i], arr_prov[i], arr_codprov[i]
+        url_img, url_pdf, prov_norm = arr_img[i], arr_pdf[i], arr_norm[i]
 
         # 1) Excluir FAMARA
-        if norm_text(prov) and any(ex in norm_text(prov) for ex in (norm_text(x) for x in EXCLUDE_PROVIDERS)):
+        if prov_norm and EXCLUDE_RE.search(prov_norm):
             stats["skipped_excluded"] += 1
             continue
 
         # 2) Filtrar por proveedor literal si se ha indicado
-        if prov_filter and prov_filter not in norm_text(prov):
+        if prov_filter and prov_filter not in prov_norm:
             stats["skipped_provider"] += 1
             continue
 
@@ -209,38 +469,81 @@ def main():
         folder_name = safe_name(f"{codprov} - {prov}") if (codprov or prov) else "SIN_PROVEEDOR"
         img_dir = imgs_root / folder_name
         pdf_dir = pdfs_root / folder_name
-        ensure_dir(img_dir); ensure_dir(pdf_dir)
+        folders.add(folder_name)
 
         # 4) Nombre base: "<Cód. Articulo Naves - Referencia Proveedor>"
         base_name = safe_name(f"{cod_art} - {refprov}".strip())
         if not base_name:
             base_name = f"fila_{i+1}"
 
-        # 5) Descargar imagen (si hay URL)
+        # 5) Encolar imagen (si hay URL)
         if url_img:
             img_dest = img_dir / f"{base_name}.jpg"
-            if img_dest.exists() and not args.overwrite:
+            if (img_dest.exists() and not args.overwrite) or img_dest in queued:
                 stats["img_skip"] += 1
+                if img_dest not in queued:
+                    on_disk.setdefault(("img", url_img), img_dest)
             else:
-                ok = download_image_as_jpg(s, url_img, img_dest)
-                if ok:
-                    stats["img_ok"] += 1
-                else:
-                    stats["img_skip"] += 1
+                jobs.setdefault(("img", url_img), []).append(img_dest)
+                queued.add(img_dest)
 
-        # 6) Descargar PDF (si hay URL)
+        # 6) Encolar PDF (si hay URL)
         if url_pdf:
             pdf_dest = pdf_dir / f"{base_name}.pdf"
-            if pdf_dest.exists() and not args.overwrite:
+            if (pdf_dest.exists() and not args.overwrite) or pdf_dest in queued:
                 stats["pdf_skip"] += 1
+                if pdf_dest not in queued:
+                    on_disk.setdefault(("pdf", url_pdf), pdf_dest)
             else:
-                ok = download_pdf(s, url_pdf, pdf_dest)
-                if ok:
-                    stats["pdf_ok"] += 1
-                else:
-                    stats["pdf_skip"] += 1
-
-    # 7) Crear ZIP
+                jobs.setdefault(("pdf", url_pdf), []).append(pdf_dest)
+                queued.add(pdf_dest)
+
+    for folder_name in folders:
+        ensure_dir(imgs_root / folder_name)
+        ensure_dir(pdfs_root / folder_name)
+
+    # 7) Una descarga por URL distinta, en paralelo (la Session es segura para GET concurrentes);
+    #    el resto de destinos de esa URL se enlazan a la primera copia
+    pending = {}
+    for key, dests in jobs.items():
+        src = on_disk.get(key)
+        if src is None:
+            pending[key] = dests
+            continue
+        for d in dests:
+            link_or_copy(src, d)
+        stats[f"{key[0]}_ok"] += len(dests)
+
+    def finish(key, ok):
+        kind, dests = key[0], pending[key]
+        if ok:
+            for d in dests[1:]:
+                link_or_copy(dests[0], d)
+        stats[f"{kind}_ok" if ok else f"{kind}_skip"] += len(dests)
+
+    # Hilos para la red; la recodificación JPEG (CPU) va a un proceso por núcleo.
+    # "spawn": no se hace fork de un proceso que ya tiene hilos de descarga activos.
+    downloaders = {"img": fetch_image, "pdf": download_pdf}
+    with ThreadPoolExecutor(max_workers=workers) as io_pool, \
+         ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn")) as cpu_pool:
+        futures = {io_pool.submit(downloaders[kind], s, url, dests[0], state): (kind, url)
+                   for (kind, url), dests in pending.items()}
+        encodes = {}
+        for fut in as_completed(futures):
+            key, res = futures[fut], fut.result()
+            if isinstance(res, tuple):
+                part, r = res
+                encodes[cpu_pool.submit(encode_jpg, part, pending[key][0])] = key, r
+            else:
+                finish(key, res)
+        for fut in as_completed(encodes):
+            (key, r), ok = encodes[fut], fut.result()
+            if ok:  # solo ahora: un fallo al recodificar no deja el ETag nuevo apuntando a la imagen vieja
+                remember(state, key[1], r, pending[key][0])
+            finish(key, ok)
+    save_state(state_path, state)
+
+    # 8) Crear ZIP
     if zip_path.exists():
         zip_path.unlink()
     if any(out_root.rglob("*")):
@@ -12,22 +12,44 @@ Mejoras:
 
 Requiere secrets en el workflow:
   GOOGLE_CSE_KEY, GOOGLE_CSE_CX
+
+(opcional) pip install pyarrow → el Excel de entrada se cachea en .parquet (lecturas siguientes
+instantáneas) y los checkpoints se escriben en parquet en vez de reescribir el xlsx entero.
+(opcional) pip install requests-cache → cachea en data/.cse_cache.sqlite las consultas CSE (7 días)
+y las páginas de proveedor (1 día); una re-ejecución no vuelve a gastar cuota.
+(opcional) pip install python-calamine → lectura del Excel de entrada bastante más rápida.
+(opcional) pip install xlsxwriter → el Excel de salida se escribe con xlsxwriter (bastante más
+rápido que openpyxl en volcados grandes).
 """
 
-import os, re, unicodedata, time, sys, csv, math, urllib.parse
+import os, re, time, sys, csv, json, itertools, threading
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from html import unescape
 from pathlib import Path
-import requests, pandas as pd
-from bs4 import BeautifulSoup
+from urllib.parse import urljoin, urlsplit
+import numpy as np, requests, pandas as pd
+import lxml.html
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+try:
+    from requests_cache import CachedSession, DO_NOT_CACHE
+except ImportError:
+    CachedSession = DO_NOT_CACHE = None
+
+from catalog_common import COLS, EXCLUDE_RE, empty_mask, excel_read_engine, norm_text
 
 print("[INFO] Engine: GOOGLE CSE (webwide) | Filtro: --provider-contains | Regla: excluir FAMARA | Hints por marca activos")
 
 # -------------------- Config --------------------
 
-BLACKLIST = {
+BLACKLIST = frozenset({
     "amazon.", "ebay.", "aliexpress.", "alibaba.", "leroymerlin.", "manomano.",
     "pinterest.", "facebook.", "instagram.", "youtube.", "issuu.", "scribd.",
     "mercadolibre.", "wikipedia.", "reddit.", "x.com", "tiktok.", "linkedin."
-}
+})
 
 # Aliases para detectar marca a partir del campo "Proveedor"
 ALIASES = {
@@ -40,6 +62,13 @@ ALIASES = {
     "":        ["LAS NAVES", "ALMACENES", "DISTRIBUIDOR", "PROVEEDOR"]
 }
 
+# variante normalizada → marca canónica (la primera definición gana, como en el recorrido de ALIASES)
+_ALIAS_INDEX = {}
+for _canon, _variants in ALIASES.items():
+    for _v in _variants:
+        _ALIAS_INDEX.setdefault(norm_text(_v), _canon)
+_CONTAINS_BRANDS = tuple(c for c in ALIASES if c)  # marcas reales, sin la entrada "" (genéricos)
+
 # Pistas por marca → dominios a priorizar
 BRAND_HINTS = {
     "FLUIDRA": [
@@ -51,187 +80,526 @@ BRAND_HINTS = {
     "GENEBRE": ["genebre.es", "genebre.com"],
 }
 
-# Proveedores a excluir (normalizado)
-EXCLUDE_PROVIDERS = {"FAMARA"}
-
-# Nombres de columnas
-COLS = {
-    "cod_art": "Cód. Articulo Naves",
-    "refprov": "Referencia Proveedor",
-    "art":     "Artículo",
-    "prov":    "Proveedor",
-    "codprov": "Cód. Proveedor",
-    "img":     "URL Imagen Oficial",
-    "pdf":     "URL Ficha Técnica Oficial",
+# Caché HTTP en disco (si requests-cache está instalado)
+CACHE_PATH = "data/.cse_cache.sqlite"
+# Resultados ya encontrados por (marca|ref|artículo): otra ejecución no repite ni consultas ni scraping
+ENRICH_CACHE_PATH = "data/.enrich_cache.json"
+CACHE_TTL = {
+    "www.googleapis.com/customsearch": 7*24*3600,  # resultados CSE: lo caro (cuota)
+    "*": 24*3600,                                  # páginas/recursos de proveedor
 }
 
-# -------------------- Utilidades --------------------
-
-def is_empty(val) -> bool:
-    if val is None: return True
-    if isinstance(val, float) and (math.isnan(val) or math.isinf(val)): return True
-    s = str(val).strip()
-    return s == "" or s.lower() == "nan" or s == "None"
+# a partir de un límite de etiqueta: "x.com" no debe casar con fox.com ni "amazon." con noamazon.es.
+# "amazon." = cualquier TLD/subdominio de amazon; "x.com" (sin punto final) = ese dominio exacto
+_BLACKLIST_RE = re.compile(r"(?:^|\.)(?:" + "|".join(
+    re.escape(b) if b.endswith(".") else re.escape(b) + r"(?::\d+)?$" for b in sorted(BLACKLIST)) + ")")
+# con punto delante: ("." + host).endswith(...) acepta el dominio y sus subdominios, no notfluidra.com
+_BRAND_SUFFIXES = {b: tuple("." + d.lower() for d in doms) for b, doms in BRAND_HINTS.items()}
+
+_PUNCT = re.compile(r"[.\s\-]+")
+_CHARSET = re.compile(r"charset=[\"']?([\w.:-]+)", re.I)
+_TRACKER = re.compile(r"(pixel|tracker|1x1|blank|spacer)\.(gif|png)", re.I)
+_LEADING_INT = re.compile(r"\s*(\d+)")
+# og:image directo sobre los bytes (atributos en cualquier orden): evita construir el árbol
+_OG_RE = re.compile(rb"""<meta\s[^>]*?(?:property|name)=["']og:image["'][^>]*?content=["']([^"']+)"""
+                    rb"""|<meta\s[^>]*?content=["']([^"']+)["'][^>]*?(?:property|name)=["']og:image["']""", re.I)
+_IMG_EXT = re.compile(r"\.(?:jpe?g|png|webp|gif)(?:[?#]|$)", re.I)
+# pistas de imagen grande en la URL: nombres de tamaño o anchos 800-1999 ("_1200", "-800x800"; no años /2024/)
+_IMG_BIG_HINT = re.compile(r"large|big|full|zoom|original|[_\-/](?:[89]\d\d|1\d{3})(?:px|x\d+)?(?:\b|_)", re.I)
+MIN_IMG_EDGE = 32  # px declarados por debajo de los cuales un <img> es icono/píxel
+IMG_MAX_PROBES = 5      # <img> con tamaño declarado que se llegan a comprobar (HEAD), por área
+IMG_UNSIZED_PROBES = 3  # si ninguno declara tamaño: los primeros del documento
+
+# XPath compilados una vez (evaluación en C por página, sin re-parsear la expresión)
+# enlaces con ".pdf" (sin distinguir mayúsculas) filtrados ya en libxml2, no en un bucle Python
+_XP_PDF_HREFS = etree.XPath('//a/@href[contains(translate(., "PDF", "pdf"), ".pdf")]')
+_XP_OG_IMAGE = etree.XPath('(//meta[@property="og:image" or @name="og:image"]/@content)[1]')
+# si og:image falta o no vale: twitter:image o la imagen de schema.org en microdatos
+_XP_META_IMAGE = etree.XPath('(//meta[@name="twitter:image" or @property="twitter:image" or @itemprop="image"]/@content)[1]')
+_XP_IMGS = etree.XPath("//img[@src]")
+
+# Columnas del informe CSV (se escribe fila a fila)
+FIELDS = ["row", "cod_articulo_naves", "ref_proveedor", "proveedor_raw", "brand_detected",
+          "chosen_host", "search_pass", "product_page", "found_image", "found_pdf", "status"]
+PARQUET_CODEC = "zstd"  # más compacto que el snappy por defecto a velocidad parecida (columnas de texto/URLs)
+CHECKPOINT_EVERY = 500  # filas resueltas entre volcados del Excel de salida
+
+PROBE_WORKERS = 16  # HEADs concurrentes a candidatos/assets (pool compartido por todas las filas)
+PAGE_PREFETCH = 3   # páginas candidatas descargadas por adelantado (en PROBE_POOL) mientras se revisa la actual
+PROBE_BATCH = 8     # comprobaciones en vuelo por página (enlaces PDF, <img>) antes de mirar resultados
+HOST_RPS = 5.0      # peticiones/s por web de proveedor (se reduce sola ante 429); --host-rps
+UNLIMITED_HOSTS = frozenset({"www.googleapis.com"})  # CSE: su propio limitador (cse_bucket)
+POOL_HOSTS = 32     # hosts distintos con pool keep-alive abierto (LRU; los proveedores se repiten)
 
-def norm_text(s:str)->str:
-    s = str(s or "").strip().upper()
-    s = unicodedata.normalize("NFKD", s)
-    s = "".join(ch for ch in s if not unicodedata.combining(ch))
-    return re.sub(r"[^A-Z0-9]+", " ", s).strip()
+# -------------------- Utilidades --------------------
 
+@lru_cache(maxsize=4096)
 def canonical_brand(raw:str)->str:
     """Intenta mapear el texto de proveedor a marca canónica."""
     n = norm_text(raw)
     if not n:
         return ""
-    for canon, variants in ALIASES.items():
-        for v in variants:
-            if norm_text(v) == n:
-                return canon
-    # heurística de "contiene"
-    for canon in ("JIMTEN","ESPA","GENEBRE","FLUIDRA"):
+    hit = _ALIAS_INDEX.get(n)
+    if hit is not None:
+        return hit
+    # heurística de "contiene" (por orden de ALIASES: la primera marca que aparezca en la lista gana)
+    for canon in _CONTAINS_BRANDS:
         if canon in n:
             return canon
     return ""
 
+@lru_cache(maxsize=4096)
 def is_excluded_provider(prov_raw: str) -> bool:
     n = norm_text(prov_raw)
-    return any(word in n for word in (norm_text(x) for x in EXCLUDE_PROVIDERS))
+    return bool(EXCLUDE_RE.search(n))
 
+@lru_cache(maxsize=8192)  # las mismas URLs vuelven en consultas de filas distintas
 def host_of(url: str) -> str:
     try:
-        return urllib.parse.urlparse(url).netloc.lower()
+        return urlsplit(url).netloc.lower()  # urlsplit: sin el troceado de ;params
     except Exception:
         return ""
 
+@lru_cache(maxsize=4096)  # los mismos hosts salen en los resultados de muchas filas
 def is_blacklisted(host: str) -> bool:
-    return any(bad in host for bad in BLACKLIST)
+    return _BLACKLIST_RE.search(host) is not None
 
+@lru_cache(maxsize=4096)
 def looks_like_brand_site(host: str, brand: str) -> bool:
     if not brand:
         return False
     brand = brand.lower()
     if brand in host:
         return True
-    # si hay hints definidos, considera match si host termina en alguno de ellos
-    for dom in BRAND_HINTS.get(brand.upper(), []):
-        d = dom.lower()
-        if host.endswith(d) or host == d or host.endswith("." + d):
-            return True
-    return False
+    # si hay hints definidos, considera match si host es uno de ellos o un subdominio
+    return ("." + host).endswith(_BRAND_SUFFIXES.get(brand.upper(), ()))
+
+def make_session(pool_size: int = 32, cache_path: str = None, host_rps: float = HOST_RPS) -> requests.Session:
+    """Session con keep-alive (un TLS por host reutilizado entre filas) y reintentos ante 429/5xx.
+    pool_size: conexiones por host; debe cubrir todos los hilos que pueden ir a la vez al mismo
+    host (filas + sondeos) o urllib3 abre y tira conexiones de sobra.
+    Con cache_path (y requests-cache instalado) las respuestas GET/HEAD se sirven desde SQLite.
+    host_rps: tope de peticiones/s por host de proveedor (HostLimitedAdapter); 0 = sin tope."""
+    if cache_path and CachedSession is not None:
+        Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+        # TTL propio por URL (las cabeceras Cache-Control de Google/proveedores no mandan);
+        # la API key no forma parte de la clave ni se guarda en disco
+        s = CachedSession(cache_path, backend="sqlite", expire_after=CACHE_TTL["*"],
+                          urls_expire_after=CACHE_TTL, cache_control=False,
+                          allowable_methods=("GET","HEAD"), allowable_codes=(200,),
+                          ignored_parameters=["key"], match_headers=False, stale_if_error=True)
+    else:
+        s = requests.Session()
+    s.headers.update({"User-Agent":"Mozilla/5.0"})
+    # raise_on_status=False: agotados los reintentos se devuelve el 429 y google_search lo convierte en QuotaExceeded
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[429,500,502,503,504], raise_on_status=False)
+    a = HostLimitedAdapter(host_rps, pool_connections=POOL_HOSTS, pool_maxsize=pool_size, max_retries=retry)
+    s.mount("https://", a); s.mount("http://", a)
+    return s
 
 # -------------------- Google CSE --------------------
 
 class QuotaExceeded(Exception): pass
 
-def google_search(session, key, cx, q, num=8, sleep_s=1.1):
+class TokenBucket:
+    """Limitador token bucket compartido por todos los hilos: `rate` consultas/s de media,
+    hasta `burst` seguidas sin espera. Si hay token no duerme nada; si no, el hilo reserva
+    el siguiente (el saldo puede quedar negativo) y espera solo lo que falta."""
+    def __init__(self, rate: float, burst: int = 1):
+        self.lock = threading.Lock()
+        self.configure(rate, burst)
+
+    def configure(self, rate: float, burst: int = 1):
+        with self.lock:
+            self.rate = rate; self.capacity = max(1, burst)
+            self.tokens = float(self.capacity); self.t = time.monotonic()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            if now > self.t:  # self.t en el futuro = limitador en pausa (pause())
+                self.tokens = min(self.capacity, self.tokens + (now - self.t) * self.rate)
+                self.t = now
+            self.tokens -= 1
+            wait = self.t - now
+            if self.tokens < 0 and self.rate > 0:  # rate <= 0: sin límite (salvo pausas)
+                wait += -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def throttle(self, seconds: float = 0.0, floor: float = 0.0):
+        """429: ritmo a la mitad (sin bajar de `floor`) y, si el servidor pidió espera, pausa."""
+        with self.lock:
+            if self.rate > 0:
+                self.rate = max(floor, self.rate / 2)
+        if seconds > 0:
+            self.pause(seconds)
+
+    def recover(self, ceiling: float):
+        """Respuesta buena tras un throttle(): el ritmo vuelve poco a poco (+5 %) hasta `ceiling`."""
+        if self.rate < ceiling:
+            with self.lock:
+                self.rate = min(ceiling, self.rate * 1.05)
+
+    def pause(self, seconds: float):
+        """Ningún hilo recibe token hasta dentro de `seconds` (429 por minuto con Retry-After):
+        los demás hilos no siguen disparando consultas que también darían 429."""
+        with self.lock:
+            until = time.monotonic() + seconds
+            if until > self.t:
+                self.t = until
+                self.tokens = min(self.tokens, 1.0)  # al reanudar, una consulta y luego al ritmo normal
+
+cse_bucket = TokenBucket(1/1.1)  # main() lo ajusta con --sleep-ms / --cse-burst
+_cse_stop = threading.Event()  # cuota diaria agotada en cualquier hilo: cortan todos
+CSE_NUM = {"hint": 5, "web": 8}  # resultados pedidos por pasada (en site: los primeros bastan)
+CSE_RATE_RETRIES = 4  # reintentos (Retry-After o 2, 4, 8, 16 s) ante límite por minuto antes de rendirse
+
+def cse_error_reason(r) -> str:
+    """Motivo del 429 de la API: 'dailyLimitExceeded', 'rateLimitExceeded'…, o '' si no viene."""
+    try:
+        err = r.json().get("error", {})
+    except ValueError:
+        return ""
+    reasons = [e.get("reason", "") for e in err.get("errors", []) or []]
+    # la API a veces da 'rateLimitExceeded' también para la cuota diaria; el mensaje lo aclara
+    if "per day" in (err.get("message") or "").lower():
+        return "dailyLimitExceeded"
+    return reasons[0] if reasons else ""
+
+def retry_after_s(r) -> float:
+    """Segundos pedidos por la cabecera Retry-After (número o fecha HTTP); 0 si no viene o no se entiende."""
+    v = (r.headers.get("Retry-After") or "").strip()
+    if not v:
+        return 0.0
+    if v.isdigit():
+        return float(v)
+    try:
+        return max(0.0, parsedate_to_datetime(v).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0.0
+
+@lru_cache(maxsize=4096)  # la misma consulta sale en grupos distintos (misma ref con otra marca…)
+def google_search(session, key, cx, q, num=10):
+    """Enlaces de los resultados CSE de q. Memorizado en el proceso: una consulta repetida no gasta
+    cuota ni espera turno en cse_bucket (tampoco sin requests-cache). Los errores no se memorizan."""
     endpoint = "https://www.googleapis.com/customsearch/v1"
-    r = session.get(endpoint, params={"key":key, "cx":cx, "q":q, "num":num}, timeout=30)
-    if r.status_code == 429:
-        raise QuotaExceeded("429 Too Many Requests from Google CSE")
+    for attempt in range(CSE_RATE_RETRIES + 1):
+        if _cse_stop.is_set():
+            raise QuotaExceeded("CSE detenido: cuota agotada en otro hilo")
+        cse_bucket.acquire()
+        # fields: la API devuelve solo los enlaces (sin snippets, pagemap ni metadatos de la búsqueda)
+        r = session.get(endpoint, params={"key":key, "cx":cx, "q":q, "num":num, "fields":"items(link)"}, timeout=30)
+        if r.status_code != 429:
+            break
+        reason = cse_error_reason(r)
+        if reason == "dailyLimitExceeded" or attempt == CSE_RATE_RETRIES:
+            _cse_stop.set()
+            raise QuotaExceeded(f"429 Too Many Requests from Google CSE ({reason or 'sin motivo'})")
+        # límite por minuto: pausa global lo que diga el servidor (o backoff exponencial) y reintentar
+        cse_bucket.pause(retry_after_s(r) or 2 ** (attempt + 1))
     r.raise_for_status()
     data = r.json()
-    time.sleep(sleep_s)
-    hits = []
-    for item in data.get("items", []) or []:
-        url = item.get("link")
-        if url:
-            hits.append(url)
-    return hits
+    return tuple(item["link"] for item in data.get("items", []) or [] if item.get("link"))
 
 # -------------------- Scraping recursos --------------------
 
-def pick_pdf_from_page(url:str, session:requests.Session):
+class HostLimitedAdapter(HTTPAdapter):
+    """HTTPAdapter con un TokenBucket por host: como mucho `rps` peticiones/s a cada web de proveedor.
+    Un 429 (ya agotados los reintentos de urllib3) baja a la mitad el ritmo de ese host y respeta su
+    Retry-After; las respuestas buenas lo recuperan poco a poco. Va por debajo de la caché HTTP:
+    lo que sirve requests-cache no gasta token. CSE (UNLIMITED_HOSTS) ya va por cse_bucket."""
+    def __init__(self, rps: float = 0, **kw):
+        super().__init__(**kw)
+        self.rps = rps
+        self.buckets = {}
+        self.buckets_lock = threading.Lock()
+
+    def bucket(self, host: str) -> TokenBucket:
+        with self.buckets_lock:
+            b = self.buckets.get(host)
+            if b is None:
+                b = self.buckets[host] = TokenBucket(self.rps, max(1, int(self.rps)))
+            return b
+
+    def send(self, request, **kw):
+        host = urlsplit(request.url).netloc.lower()
+        if self.rps <= 0 or host in UNLIMITED_HOSTS:
+            return super().send(request, **kw)
+        b = self.bucket(host)
+        b.acquire()
+        r = super().send(request, **kw)
+        if r.status_code == 429:
+            b.throttle(retry_after_s(r), floor=self.rps / 16)
+        else:
+            b.recover(self.rps)
+        return r
+
+PROBE_POOL = ThreadPoolExecutor(max_workers=PROBE_WORKERS, thread_name_prefix="probe")
+PAGE_TYPES = ("text/html", "application/xhtml", "application/pdf", "image/")  # lo que los pickers saben usar
+ASSET_TYPES = ("application/pdf", "image/")  # resultados que ya son el recurso buscado
+
+@lru_cache(maxsize=4096)
+def probe_content_type(session, url: str) -> str:
+    """Content-Type de un recurso sin bajar el cuerpo (HEAD; si el servidor no acepta HEAD, 405/501,
+    un GET de 1 byte con Range). "" si no responde o da error (4xx/5xx).
+    Cacheado por URL: el mismo asset aparece en muchas filas/páginas."""
+    try:
+        r = session.head(url, allow_redirects=True, timeout=10)
+        if r.status_code in (405, 501):
+            # el with cierra la respuesta aunque el servidor ignore el Range y mande el recurso entero
+            with session.get(url, headers={"Range": "bytes=0-0"}, timeout=10, stream=True, **uncached(session)) as r:
+                return r.headers.get("Content-Type","").lower() if r.ok else ""
+        return r.headers.get("Content-Type","").lower() if r.ok else ""
+    except Exception:
+        return ""
+
+def charset_of(ct: str):
+    """Codificación declarada en el Content-Type (charset=...), o None."""
+    m = _CHARSET.search(ct or "")
+    return m.group(1).lower() if m else None
+
+_parsers = threading.local()  # los parsers de lxml no se comparten entre hilos: uno por hilo y charset
+
+def html_parser(encoding):
+    """HTMLParser de lxml para esa codificación (reutilizado dentro del hilo)."""
+    cache = _parsers.__dict__.setdefault("by_enc", {})
+    if encoding not in cache:
+        try:
+            cache[encoding] = lxml.html.HTMLParser(encoding=encoding)
+        except LookupError:  # charset inventado por el servidor: que lxml lo deduzca del <meta>
+            cache[encoding] = lxml.html.HTMLParser()
+    return cache[encoding]
+
+def parse_html(html: bytes, ct: str):
+    """Árbol lxml desde los bytes; con el charset de la cabecera si lo hay (si solo viene en la
+    cabecera y no en un <meta>, lxml por sí solo decodificaría mal los acentos)."""
+    cs = charset_of(ct)
+    return lxml.html.fromstring(html, parser=html_parser(cs)) if cs else lxml.html.fromstring(html)
+
+@lru_cache(maxsize=256)
+def fetch_page(session, url: str):
+    """(content_type, html en bytes) de una página candidata, o None si falla.
+    Cacheado: pick_pdf_from_page y pick_image_from_page comparten una sola descarga por página.
+    Si la URL ya es un PDF/imagen el cuerpo no se usa (con requests-cache sí se descarga para guardarlo;
+    los recursos directos ya se resuelven antes, con el HEAD de try_enrich_with_hints)."""
     try:
-        r = session.get(url, timeout=30)
-        r.raise_for_status()
-        if (r.headers.get("Content-Type","").lower().startswith("application/pdf")):
-            return url
-        soup = BeautifulSoup(r.text, "lxml")
-        for a in soup.select("a[href]"):
-            href = a["href"]
-            if ".pdf" in href.lower():
-                pdf = requests.compat.urljoin(url, href)
-                head = session.get(pdf, timeout=30, stream=True)
-                ct = head.headers.get("Content-Type","").lower()
-                if "application/pdf" in ct:
-                    return pdf
+        with session.get(url, timeout=30, stream=True) as r:
+            r.raise_for_status()
+            ct = r.headers.get("Content-Type","").lower()
+            if ct.startswith(("application/pdf", "image/")):
+                return ct, b""
+            return ct, r.content  # bytes: lxml detecta la codificación, sin decodificar en Python
     except Exception:
         return None
+
+def uncached(session) -> dict:
+    """kwargs para que una petición no pase por la caché HTTP (un 206 parcial no debe guardarse
+    ni obligar a requests-cache a leer el cuerpo entero para almacenarlo)."""
+    if CachedSession is not None and isinstance(session, CachedSession):
+        return {"expire_after": DO_NOT_CACHE}
+    return {}
+
+@lru_cache(maxsize=4096)
+def is_pdf(session, url: str) -> bool:
+    """PDF por Content-Type (HEAD) o, si el servidor lo etiqueta mal (octet-stream, text/html…),
+    por los bytes mágicos %PDF- de un GET con Range de 8 bytes."""
+    if "pdf" in probe_content_type(session, url):
+        return True
+    try:
+        with session.get(url, headers={"Range": "bytes=0-7"}, timeout=8, stream=True, **uncached(session)) as r:
+            return r.ok and r.raw.read(5, decode_content=True).startswith(b"%PDF-")
+    except Exception:
+        return False
+
+def first_probed(check, urls, batch=PROBE_BATCH):
+    """Primera URL (en orden) para la que check(url) es cierto. Las comprobaciones van en paralelo
+    en PROBE_POOL por tandas de `batch`: se espera el RTT más lento de la tanda, no la suma.
+    No llamar desde una tarea de PROBE_POOL (esperaría a su propio pool)."""
+    for k in range(0, len(urls), batch):
+        chunk = urls[k:k+batch]
+        for u, ok in zip(chunk, PROBE_POOL.map(check, chunk)):
+            if ok:
+                return u
     return None
 
-def pick_image_from_page(url:str, session:requests.Session):
+def page_tree(session, url: str):
+    """Árbol de una página HTML candidata (una sola descarga y un solo parseo para los dos pickers);
+    None si falla o si la URL no es HTML (PDF/imagen directos, que los pickers resuelven por su cuenta)."""
+    page = fetch_page(session, url)
+    if page is None or page[0].startswith(("application/pdf", "image/")):
+        return None
     try:
-        r = session.get(url, timeout=30)
-        r.raise_for_status()
-        if r.headers.get("Content-Type","").lower().startswith("image/"):
-            return url
-        soup = BeautifulSoup(r.text, "lxml")
-        # og:image primero
-        og = soup.select_one('meta[property="og:image"], meta[name="og:image"]')
-        if og and og.get("content"):
-            candidate = requests.compat.urljoin(url, og["content"])
-            ct = session.get(candidate, timeout=30, stream=True).headers.get("Content-Type","").lower()
+        return parse_html(page[1], page[0])
+    except Exception:
+        return None
+
+def pick_pdf_from_page(url:str, session:requests.Session, tree=None):
+    """tree: árbol ya parseado de la página (page_tree), para no volver a parsearla."""
+    try:
+        if tree is None:
+            page = fetch_page(session, url)
+            if page is None:
+                return None
+            ct, html = page
+            if ct.startswith("application/pdf"):
+                return url
+            tree = parse_html(html, ct)
+        pdfs = dict.fromkeys(urljoin(url, href) for href in _XP_PDF_HREFS(tree))
+        return first_probed(lambda u: is_pdf(session, u), list(pdfs))
+    except Exception:
+        return None
+    return None
+
+def fetch_og_streaming(session, url: str):
+    """Lee la página en trozos y corta la descarga al ver <meta og:image> (suele ir en los
+    primeros KB del <head>). Devuelve (content_type, og, tree): og si apareció (tree None);
+    si no, el árbol de la página completa para el barrido de <img>. None si falla.
+    Sin caché HTTP: en un fallo de caché requests-cache lee el cuerpo entero para guardarlo
+    antes de que iter_content devuelva nada, y el corte en og:image no serviría de nada."""
+    try:
+        with session.get(url, timeout=30, stream=True, **uncached(session)) as r:
+            r.raise_for_status()
+            ct = r.headers.get("Content-Type","").lower()
+            if ct.startswith(("application/pdf", "image/")):
+                return ct, None, None
+            try:
+                parser = etree.HTMLPullParser(events=("start",), encoding=charset_of(ct))
+            except LookupError:
+                parser = etree.HTMLPullParser(events=("start",))
+            for chunk in r.iter_content(65536):
+                parser.feed(chunk)
+                for _, el in parser.read_events():
+                    if el.tag == "meta" and "og:image" in (el.get("property"), el.get("name")) and el.get("content"):
+                        return ct, el.get("content"), None
+            return ct, None, parser.close()
+    except Exception:
+        return None
+
+def og_from_bytes(html: bytes, ct: str = ""):
+    """og:image de la página con una regex sobre los bytes (sin parsear), o None si no aparece."""
+    m = _OG_RE.search(html)
+    if not m:
+        return None
+    raw = m.group(1) or m.group(2)
+    try:
+        return unescape(raw.decode(charset_of(ct) or "utf-8", "ignore")).strip() or None
+    except LookupError:
+        return unescape(raw.decode("utf-8", "ignore")).strip() or None
+
+def html_dim(v) -> int:
+    """width/height de un <img> ("300", "300px"); 0 si falta o no es un número."""
+    m = _LEADING_INT.match(v or "")
+    return int(m.group(1)) if m else 0
+
+def pick_image_from_page(url:str, session:requests.Session, stream:bool=False, tree=None):
+    """stream=True cuando de la página solo interesa la imagen (nadie más va a leer el HTML):
+    se para de descargar en og:image en vez de bajar la página entera.
+    tree: árbol ya parseado de la página (page_tree), compartido con pick_pdf_from_page."""
+    try:
+        og = None
+        if tree is None:
+            if stream:
+                page = fetch_og_streaming(session, url)
+                if page is None:
+                    return None
+                ct, og, tree = page
+            else:
+                page = fetch_page(session, url)
+                if page is None:
+                    return None
+                ct, html = page
             if ct.startswith("image/"):
+                return url
+            if ct.startswith("application/pdf"):
+                return None
+            if not stream:
+                og = og_from_bytes(html, ct)  # camino rápido: el árbol solo se construye si hace falta
+                if og is None:
+                    tree = parse_html(html, ct)
+        is_img = lambda u: probe_content_type(session, u).startswith("image/")
+        # og:image primero
+        if og is None and tree is not None:
+            og = (_XP_OG_IMAGE(tree) or [None])[0]
+        if og:
+            candidate = urljoin(url, og)
+            if is_img(candidate):
                 return candidate
-        # por tamaño (si vienen width/height)
-        best = None; best_area = 0
-        for img in soup.select("img[src]"):
-            src = img["src"]
-            candidate = requests.compat.urljoin(url, src)
-            if ".svg" in candidate.lower():
+        if tree is None:  # og:image que no era imagen (cortado en stream o por regex): hace falta el árbol
+            page = fetch_page(session, url)
+            if page is None:
+                return None
+            tree = parse_html(page[1], page[0])
+        meta = (_XP_META_IMAGE(tree) or [None])[0]
+        if meta and meta != og:  # twitter:image suele repetir la og:image ya descartada
+            candidate = urljoin(url, meta)
+            if is_img(candidate):
+                return candidate
+        # por tamaño (si vienen width/height): se filtra y ordena antes de gastar ningún HEAD
+        sized, unsized = [], []
+        for img in _XP_IMGS(tree):
+            src = img.get("src").strip()
+            if src.startswith("data:") or _TRACKER.search(src):
                 continue
-            try:
-                head = session.get(candidate, timeout=30, stream=True)
-                ct = head.headers.get("Content-Type","").lower()
-                if ct.startswith("image/"):
-                    w = int(img.get("width") or 0); h = int(img.get("height") or 0)
-                    area = w*h
-                    if area > best_area:
-                        best_area, best = area, candidate
-            except Exception:
+            w, h = html_dim(img.get("width")), html_dim(img.get("height"))
+            if (w and w < MIN_IMG_EDGE) or (h and h < MIN_IMG_EDGE):
                 continue
-        return best
+            candidate = urljoin(url, src)
+            if ".svg" in candidate.lower():
+                continue
+            if w and h:
+                sized.append((w*h, candidate))
+            else:
+                unsized.append(candidate)  # sin tamaño declarado: solo por si ninguna lo declara
+        sized.sort(key=lambda t: t[0], reverse=True)
+        # de mayor a menor área (las IMG_MAX_PROBES primeras); si ninguna declara tamaño, por pistas
+        # de la URL (extensión de imagen, "large"/"zoom"/"_1200"…) y, a igualdad, orden del documento
+        if sized:
+            cands = list(dict.fromkeys(c for _, c in sized))[:IMG_MAX_PROBES]
+        else:
+            unsized.sort(key=lambda c: (not _IMG_EXT.search(c), not _IMG_BIG_HINT.search(c)))
+            cands = list(dict.fromkeys(unsized))[:IMG_UNSIZED_PROBES]
+        # la favorita se comprueba sola (un HEAD); solo si falla se prueban las demás
+        return first_probed(is_img, cands[:1]) or first_probed(is_img, cands[1:])
     except Exception:
         return None
 
 # -------------------- Construcción de queries --------------------
 
 def ref_variants(ref: str):
-    """Genera variantes robustas de la referencia."""
+    """Variantes de la referencia: tal cual y sin guiones/puntos/espacios (ordenadas, sin repetir)."""
     ref = (ref or "").strip()
     if not ref:
-        return set()
-    v = set()
-    v.add(ref)
-    v.add(ref.replace("-", ""))                  # sin guiones
-    v.add(re.sub(r"[.\s]+", "", ref))           # sin puntos/espacios
-    v.add(ref.replace(" ", ""))                 # sin espacios
-    v.add(ref.replace(".", ""))                 # sin puntos
-    return {x for x in v if x}
+        return []
+    return [x for x in dict.fromkeys((ref, _PUNCT.sub("", ref))) if x]
+
+def ref_key(ref: str) -> str:
+    """Forma canónica de una referencia para agrupar filas: la de ref_variants sin signos, en mayúsculas."""
+    return _PUNCT.sub("", ref or "").upper()
+
+def or_groups(variants, size=4):
+    """Agrupa variantes en '(A OR B ...)': una sola consulta CSE (facturable) cubre varias grafías.
+    En grupos de `size` para no pasar el límite de 32 palabras por consulta."""
+    variants = [f'"{v}"' if " " in v else v for v in variants]
+    for k in range(0, len(variants), size):
+        chunk = variants[k:k+size]
+        yield chunk[0] if len(chunk) == 1 else "(" + " OR ".join(chunk) + ")"
 
 def build_queries(brand: str, ref: str, art: str):
     """Crea lista ordenada de consultas (sin site:)."""
     queries = []
-    rset = ref_variants(ref) or {""}
     art = (art or "").strip()
     brand = (brand or "").strip()
-    for rv in rset:
-        if rv:
-            queries.append(rv)
-            if art:    queries.append(f"{rv} {art}")
-            if brand:  queries.append(f"{brand} {rv}")
-            if brand and art: queries.append(f"{brand} {rv} {art}")
+    for rv in or_groups(ref_variants(ref)):
+        queries.append(rv)
+        if art:    queries.append(f"{rv} {art}")
+        if brand:  queries.append(f"{brand} {rv}")
+        if brand and art: queries.append(f"{brand} {rv} {art}")
     # si no hay ref, usa artículo con marca
     if not ref and art:
         queries.append(art)
         if brand: queries.append(f"{brand} {art}")
-    # dedup manteniendo orden
-    seen, ordered = set(), []
-    for q in queries:
-        if q not in seen:
-            seen.add(q); ordered.append(q)
-    return ordered
+    return list(dict.fromkeys(queries))  # dedup manteniendo orden
 
 def build_site_queries(domains, brand: str, ref: str, art: str):
     """Crea queries con 'site:<dom>' primero (prioriza oficiales)."""
@@ -244,50 +612,143 @@ def build_site_queries(domains, brand: str, ref: str, art: str):
 
 # -------------------- Enriquecimiento por fila --------------------
 
-def try_enrich_with_hints(brand: str, ref: str, art: str, session, key, cx, sleep_s):
-    """Primero busca en dominios oficiales (hints), luego en la web general."""
-    candidates, seen = [], set()
-
-    # 1) Site-hints si hay lista para esa marca
+def iter_queries(brand: str, ref: str, art: str):
+    """(pasada, query) en orden de prioridad: site:<dominio oficial> (hints) primero, luego webwide."""
     domains = BRAND_HINTS.get((brand or "").upper(), [])
-    if domains:
-        for q in build_site_queries(domains, brand, ref, art):
-            for u in google_search(session, key, cx, q, num=8, sleep_s=sleep_s):
-                if u not in seen:
-                    seen.add(u); candidates.append(("hint", u))
-
-    # 2) Webwide
+    for q in build_site_queries(domains, brand, ref, art):
+        yield "hint", q
     for q in build_queries(brand, ref, art):
-        for u in google_search(session, key, cx, q, num=8, sleep_s=sleep_s):
-            if u not in seen:
-                seen.add(u); candidates.append(("web", u))
-
-    # Escoger recursos
-    for pass_name, url in candidates:
-        h = host_of(url)
-        if is_blacklisted(h):
-            continue
-        # en la pasada "hint" somos más permisivos con host (ya va filtrado por site:)
-        if pass_name == "web" and brand and not looks_like_brand_site(h, brand):
-            # para webwide, preferimos hosts que parezcan de marca
-            continue
-        pdf = pick_pdf_from_page(url, session)
-        img = pick_image_from_page(url, session)
-        if pdf or img:
-            return img, pdf, url, h, pass_name
+        yield "web", q
+
+def try_enrich_with_hints(brand: str, ref: str, art: str, session, key, cx,
+                          need_img: bool = True, need_pdf: bool = True, max_queries: int = 0):
+    """Primero busca en dominios oficiales (hints), luego en la web general.
+    Las consultas CSE se lanzan de una en una y se revisan sus resultados antes de la siguiente:
+    en cuanto una página da recurso se devuelve y el resto de consultas no se gastan.
+    max_queries > 0 limita las consultas CSE de la fila."""
+    seen = set()
+    queries = iter_queries(brand, ref, art)
+    if max_queries > 0:
+        queries = itertools.islice(queries, max_queries)
+    for pass_name, q in queries:
+        hits = []
+        for url in google_search(session, key, cx, q, num=CSE_NUM[pass_name]):
+            if url in seen:
+                continue
+            seen.add(url)
+            h = host_of(url)
+            if is_blacklisted(h):
+                continue
+            # en la pasada "hint" somos más permisivos con host (ya va filtrado por site:)
+            if pass_name == "web" and brand and not looks_like_brand_site(h, brand):
+                # para webwide, preferimos hosts que parezcan de marca
+                continue
+            hits.append((url, h))
+        # HEAD en paralelo antes de los pickers: 404, errores y tipos inútiles no cuestan un GET completo
+        cts = PROBE_POOL.map(lambda hit: probe_content_type(session, hit[0]), hits)
+        ok = [(url, h, ct) for (url, h), ct in zip(hits, cts) if ct.startswith(PAGE_TYPES)]
+        prefetch = {}  # url -> future de fetch_page (la página queda en su lru_cache para los pickers)
+        for k, (url, h, ct) in enumerate(ok):
+            if ct.startswith(ASSET_TYPES):
+                # enlace directo al PDF/imagen (el HEAD de arriba ya lo confirmó): sin GET ni pickers
+                pdf = url if need_pdf and ct.startswith("application/pdf") else None
+                img = url if need_img and ct.startswith("image/") else None
+                if pdf or img:
+                    return img, pdf, url, h, pass_name
+                continue
+            if need_pdf:  # hará falta la página entera: las PAGE_PREFETCH siguientes se bajan mientras tanto
+                for u, _, c in ok[k:k+PAGE_PREFETCH]:
+                    if u not in prefetch and not c.startswith(ASSET_TYPES):
+                        prefetch[u] = PROBE_POOL.submit(fetch_page, session, u)
+                prefetch[url].result()
+            # solo se busca lo que le falta a la fila; si son las dos cosas, sobre un mismo árbol
+            tree = page_tree(session, url) if need_pdf and need_img else None
+            pdf = pick_pdf_from_page(url, session, tree=tree) if need_pdf else None
+            img = pick_image_from_page(url, session, stream=not need_pdf, tree=tree) if need_img else None
+            if pdf or img:
+                return img, pdf, url, h, pass_name
     return None, None, None, None, None
 
 # -------------------- Programa principal --------------------
 
+def load_enrich_cache(path: str) -> dict:
+    """clave "marca|proveedor|ref|art" → [img, pdf, página, host, pasada]; {} si no existe o está corrupta."""
+    try:
+        return json.loads(Path(path).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+def save_enrich_cache(cache: dict, path: str):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(path).with_suffix(".tmp")
+    tmp.write_text(json.dumps(cache, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, path)
+
+def has_parquet() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def excel_write_engine():
+    """Motor para to_excel: xlsxwriter si está instalado; si no, None (el de pandas, openpyxl)."""
+    try:
+        import xlsxwriter  # noqa: F401
+        return "xlsxwriter"
+    except ImportError:
+        return None
+
+TEXT_COLS = ("refprov", "art", "prov", "img", "pdf")  # columnas que se leen como texto (dtype string)
+
+def load_catalog(path: str) -> pd.DataFrame:
+    """Lee el Excel (con calamine si está instalado); con pyarrow lo cachea en <nombre>.parquet y lo reutiliza mientras el xlsx no cambie."""
+    cache = Path(path).with_suffix(".parquet")
+    if has_parquet() and cache.exists() and cache.stat().st_mtime >= Path(path).stat().st_mtime:
+        print(f"[INFO] Leyendo caché {cache}")
+        return pd.read_parquet(cache)
+    # todas las columnas (la salida las reescribe), pero las de texto como texto: una referencia
+    # 12345 no debe llegar como 12345.0 a las consultas ni una columna de URLs vacía como float
+    df = pd.read_excel(path, sheet_name=0, engine=excel_read_engine(),
+                       dtype={COLS[k]: "string" for k in TEXT_COLS})
+    if has_parquet():
+        try:
+            df.to_parquet(cache, index=False, compression=PARQUET_CODEC)
+        except Exception as e:  # columnas con tipos mezclados que arrow no sabe serializar
+            cache.unlink(missing_ok=True)
+            print(f"[WARN] Sin caché parquet ({e})")
+    return df
+
+def save_output(df: pd.DataFrame, path: str, fmt: str = "xlsx"):
+    """Escribe a un temporal y lo publica con os.replace: un corte a mitad no deja un fichero roto."""
+    if fmt == "parquet":
+        dest = Path(path).with_suffix(".parquet")
+        tmp = dest.with_name(dest.stem + ".tmp.parquet")
+        df.to_parquet(tmp, index=False, compression=PARQUET_CODEC)
+    else:
+        dest = Path(path)
+        tmp = dest.with_name(dest.stem + ".tmp.xlsx")
+        df.to_excel(tmp, index=False, engine=excel_write_engine())
+    os.replace(tmp, dest)
+
 def main():
     import argparse
     ap = argparse.ArgumentParser()
     ap.add_argument("--excel", default="data/RESUMEN_CATALOGO.xlsx")
     ap.add_argument("--out",    default="data/RESUMEN_CATALOGO_READY.xlsx")
     ap.add_argument("--report", default="data/ENRICHMENT_REPORT.csv")
+    ap.add_argument("--out-format", choices=("xlsx","parquet"), default="xlsx",
+                    help="Formato final de --out (parquet: misma ruta con extensión .parquet; requiere pyarrow)")
     ap.add_argument("--limit",  type=int, default=0, help="Máx filas (0=todas). Suele usarse 0 con workflow de subset.")
     ap.add_argument("--offset", type=int, default=0, help="Inicio (0-based)")
-    ap.add_argument("--sleep-ms", type=int, default=1100, help="Pausa entre consultas CSE (ms)")
+    ap.add_argument("--sleep-ms", type=int, default=1100, help="Intervalo medio entre consultas CSE (ms), global a todos los hilos")
+    ap.add_argument("--cse-burst", type=int, default=1, help="Consultas CSE seguidas permitidas sin espera (token bucket)")
+    ap.add_argument("--max-queries-per-row", type=int, default=0, help="Tope de consultas CSE por fila (0=sin tope)")
+    ap.add_argument("--host-rps", type=float, default=HOST_RPS, help="Peticiones/s máx. por web de proveedor (0=sin tope)")
+    ap.add_argument("--workers", type=int, default=8, help="Filas en paralelo (scraping y espera de red solapados)")
+    ap.add_argument("--cache", default=CACHE_PATH, help="SQLite de caché HTTP (requiere requests-cache)")
+    ap.add_argument("--enrich-cache", default=ENRICH_CACHE_PATH, help="JSON con los resultados ya encontrados por (marca, ref)")
+    ap.add_argument("--no-cache", action="store_true", help="Vacía las cachés antes de empezar (todo se vuelve a pedir)")
     ap.add_argument("--provider-contains", default="", help='Procesar SOLO filas cuyo "Proveedor" contenga este texto (normalizado). Vacío = todas')
     args = ap.parse_args()
 
@@ -295,14 +756,28 @@ def main():
         print(f"[ERROR] Excel not found: {args.excel}")
         sys.exit(1)
 
-    df = pd.read_excel(args.excel, sheet_name=0)
+    df = load_catalog(args.excel)
+    if args.out_format == "parquet" and not has_parquet():
+        print("[ERROR] --out-format parquet requiere pyarrow.")
+        sys.exit(1)
+    # checkpoints en parquet si se puede (segundos); si no, xlsx completo
+    ckpt_fmt = "parquet" if has_parquet() else "xlsx"
     for key in ("img","pdf"):
         if COLS[key] not in df.columns:
             df[COLS[key]] = ""
-
-    s = requests.Session()
-    s.headers.update({"User-Agent":"Mozilla/5.0"})
+        elif df[COLS[key]].dtype != object:
+            # una columna de URLs vacía llega del Excel como float64 (todo NaN): se pasa a object una
+            # vez aquí para que apply_updates escriba texto sin que pandas tenga que convertirla
+            df[COLS[key]] = df[COLS[key]].astype(object)
+
+    workers = max(1, args.workers)
+    s = make_session(max(32, workers + PROBE_WORKERS), cache_path=args.cache, host_rps=args.host_rps)
+    if hasattr(s, "cache"):
+        if args.no_cache:
+            s.cache.clear()
+        print(f"[INFO] Caché HTTP: {args.cache}{' (vaciada)' if args.no_cache else ''}")
     sleep_s = max(0.0, args.sleep_ms / 1000.0)
+    cse_bucket.configure(1.0 / sleep_s if sleep_s else 0, args.cse_burst)
 
     # Secrets
     key = os.environ.get("GOOGLE_CSE_KEY")
@@ -312,88 +787,209 @@ def main():
         sys.exit(1)
 
     prov_filter = norm_text(args.provider_contains)
-    total = len(df); filled = 0
-    rows = []
+    total = len(df); filled = 0; done = 0
     start = max(0, int(args.offset))
     end = total if int(args.limit) == 0 else min(total, start + int(args.limit))
 
     print(f"[INFO] Processing rows {start}..{end-1} of {total}  (provider_contains='{args.provider_contains}')")
 
-    class StopRun(Exception): pass
-
-    try:
-        for i in range(start, end):
-            row = df.iloc[i]
-            cod_art  = row.get(COLS["cod_art"])
-            ref      = str(row.get(COLS["refprov"]) or "").strip()
-            art      = str(row.get(COLS["art"]) or "").strip()
-            prov_raw = str(row.get(COLS["prov"]) or "").strip()
-            brand    = canonical_brand(prov_raw)  # puede salir "" si el proveedor no encaja con ALIASES
-
-            # Excluir FAMARA
-            if is_excluded_provider(prov_raw):
-                rows.append({
-                    "row": i+1, "cod_articulo_naves": cod_art, "ref_proveedor": ref,
-                    "proveedor_raw": prov_raw, "brand_detected": brand or "",
-                    "chosen_host": "", "search_pass": "proveedor_excluido",
-                    "product_page": "", "found_image": "", "found_pdf": "", "status": "skipped_by_rule"
-                })
-                continue
-
-            # Filtro literal por proveedor (normalizado)
-            if prov_filter and prov_filter not in norm_text(prov_raw):
-                rows.append({
-                    "row": i+1, "cod_articulo_naves": cod_art, "ref_proveedor": ref,
-                    "proveedor_raw": prov_raw, "brand_detected": brand or "",
-                    "chosen_host": "", "search_pass": "skipped_provider_filter",
-                    "product_page": "", "found_image": "", "found_pdf": "", "status": "skipped_by_provider"
-                })
-                continue
-
-            need_img = is_empty(row.get(COLS["img"]))
-            need_pdf = is_empty(row.get(COLS["pdf"]))
-            status = "skipped"; found_img = found_pdf = page = used_pass = host = None
-
-            if not (need_img or need_pdf):
-                status = "already had URLs"
+    # Filtros vectorizados sobre el tramo [start, end): las funciones de texto se evalúan
+    # una vez por proveedor distinto (pocos cientos), no una vez por fila
+    sub = df.iloc[start:end]
+    def text_col(c):
+        if c not in sub.columns:
+            return pd.Series("", index=sub.index, dtype=object)
+        return sub[c].fillna("").astype(str).str.strip()
+    provs = text_col(COLS["prov"])
+    uniq = provs.unique()
+    brands   = provs.map({v: canonical_brand(v) for v in uniq})  # puede salir "" si no encaja con ALIASES
+    excluded = provs.map({v: is_excluded_provider(v) for v in uniq}).to_numpy(bool)  # Excluir FAMARA
+    if prov_filter:  # filtro literal por proveedor (subcadena normalizada)
+        prov_match = provs.map({v: prov_filter in norm_text(v) for v in uniq}).to_numpy(bool)
+    else:
+        prov_match = np.ones(len(sub), dtype=bool)
+    need_img_a = empty_mask(sub[COLS["img"]]).to_numpy(bool)
+    need_pdf_a = empty_mask(sub[COLS["pdf"]]).to_numpy(bool)
+    todo = ~excluded & prov_match & (need_img_a | need_pdf_a)
+
+    # Acceso por posición j (0..len(sub)-1) a arrays NumPy: nada de df.iloc[i]/Series.at por fila.
+    # labels[j] es la etiqueta de df para escribir; la fila del informe es start + j + 1.
+    labels = sub.index
+    cod_a = sub[COLS["cod_art"]].to_numpy() if COLS["cod_art"] in sub.columns else [None] * len(sub)
+    ref_a, art_a, prov_a = text_col(COLS["refprov"]).to_numpy(), text_col(COLS["art"]).to_numpy(), provs.to_numpy()
+    brand_a = brands.to_numpy()
+
+    def skip_row(j, status, search_pass=""):
+        return {
+            "row": start+j+1, "cod_articulo_naves": cod_a[j], "ref_proveedor": ref_a[j],
+            "proveedor_raw": prov_a[j], "brand_detected": brand_a[j],
+            "chosen_host": "", "search_pass": search_pass,
+            "product_page": "", "found_image": "", "found_pdf": "", "status": status
+        }
+
+    # informe en streaming: cada decisión se escribe al momento (memoria constante, nada se pierde si se corta)
+    Path(args.report).parent.mkdir(parents=True, exist_ok=True)
+    report_f = open(args.report, "w", newline="", encoding="utf-8")
+    w = csv.DictWriter(report_f, fieldnames=FIELDS)
+    w.writeheader()
+    w.writerows(skip_row(j, "skipped_by_rule", "proveedor_excluido") for j in excluded.nonzero()[0])
+    w.writerows(skip_row(j, "skipped_by_provider", "skipped_provider_filter")
+                for j in (~excluded & ~prov_match).nonzero()[0])
+    w.writerows(skip_row(j, "already had URLs") for j in (~excluded & prov_match & ~todo).nonzero()[0])
+    n_todo = int(todo.sum())
+    print(f"[INFO] Filas a enriquecer: {n_todo}/{len(sub)}")
+
+    # Si el filtro de proveedor dice FLUIDRA pero brand= "", fuerzo brand "FLUIDRA"
+    # para que activen sus hints (útil cuando Proveedor es "Fluidra Commercial S.A.U." etc.)
+    if prov_filter and "FLUIDRA" in prov_filter:
+        brand_a = brands.mask(brands == "", "FLUIDRA").to_numpy()
+
+    # Filas con la misma (marca, referencia, artículo) son el mismo producto (mismo SKU repetido):
+    # una sola búsqueda por grupo y el resultado se reparte. El artículo sigue en la clave aunque haya
+    # referencia: referencias genéricas ("DN125") las comparten artículos distintos.
+    # la referencia se compara canónica (sin puntos/guiones/espacios, en mayúsculas): "AB-12.3" y "ab 123"
+    # son la misma; el artículo normalizado (norm_text); las consultas usan la grafía de la primera fila.
+    # Sin marca reconocida la marca no distingue nada: entra el proveedor normalizado en la clave, o dos
+    # proveedores con la misma referencia ("033001", "DN125"…) compartirían búsqueda y resultado
+    prov_key = provs.map({v: norm_text(v) for v in uniq}).to_numpy()
+    keys = pd.DataFrame({"brand": brand_a, "prov": np.where(brand_a == "", prov_key, ""),
+                         "ref": [ref_key(r) for r in ref_a],
+                         "art": text_col(COLS["art"]).map(norm_text).to_numpy()})
+    KEY = ["brand", "prov", "ref", "art"]
+    # .groups da etiquetas de keys, que son las posiciones j (RangeIndex); .indices serían posiciones tras filtrar
+    groups = {k: v.to_numpy() for k, v in keys[todo].groupby(KEY, sort=False).groups.items()}
+    print(f"[INFO] Búsquedas distintas: {len(groups)} (para {n_todo} filas)")
+
+    # URLs que ya tiene otra fila del mismo producto (misma clave, que incluye el proveedor si no hay
+    # marca reconocida; p.ej. una "already had URLs"): se copian a las que les faltan y eso ya no se busca.
+    # El informe marca esas copias ("filled from sibling") para poder revisarlas
+    def known_urls(col, need):
+        have = ~excluded & prov_match & ~need
+        urls = keys[have].assign(url=text_col(col).to_numpy()[have])
+        return urls.groupby(KEY, sort=False)["url"].first().to_dict()
+    sib_img, sib_pdf = known_urls(COLS["img"], need_img_a), known_urls(COLS["pdf"], need_pdf_a)
+
+    pending = {}  # future -> (clave de caché, posiciones del grupo, (img, pdf) de filas hermanas)
+    recorded = set()  # futuros ya volcados al informe (lo que quede se recoge tras el shutdown)
+    img_updates, pdf_updates = {}, {}  # etiqueta de fila -> URL encontrada; se vuelcan a df en bloque
+
+    def apply_updates():
+        """Una asignación vectorizada por columna (antes de cada volcado), no un df.at por celda."""
+        for col, upd in ((COLS["img"], img_updates), (COLS["pdf"], pdf_updates)):
+            if upd:
+                df.loc[list(upd), col] = pd.Series(upd)
+                upd.clear()
+
+    # df solo se toca desde este hilo; los hilos solo buscan
+    ex = ThreadPoolExecutor(max_workers=workers)
+
+    enrich_cache = {} if args.no_cache else load_enrich_cache(args.enrich_cache)
+
+    def with_sib(result, sib):
+        """Resultado de búsqueda/caché completado con lo que ya aportan las filas hermanas."""
+        return (sib[0] or result[0], sib[1] or result[1], *result[2:])
+
+    def record(js, result, sib=("", "")):
+        """Reparte el resultado de un grupo a sus filas (cada una toma lo que le falta) y lo informa."""
+        nonlocal filled, done
+        img, pdf, page, host, used_pass = result
+        for j in js:
+            found_img = img if need_img_a[j] else None
+            found_pdf = pdf if need_pdf_a[j] else None
+            if found_img or found_pdf:
+                if found_img: img_updates[labels[j]] = found_img
+                if found_pdf: pdf_updates[labels[j]] = found_pdf
+                filled += 1
+                copied = [u == c for u, c in ((found_img, sib[0]), (found_pdf, sib[1])) if u]
+                status = ("filled from sibling" if all(copied) else
+                          "filled, partly from sibling" if any(copied) else "filled")
             else:
-                # Si el filtro de proveedor dice FLUIDRA pero brand= "", fuerzo brand "FLUIDRA"
-                # para que activen sus hints (útil cuando Proveedor es "Fluidra Commercial S.A.U." etc.)
-                if not brand and prov_filter and "FLUIDRA" in prov_filter:
-                    brand = "FLUIDRA"
+                status = "no match"
 
-                try:
-                    img, pdf, page, host, used_pass = try_enrich_with_hints(brand, ref, art, s, key, cx, sleep_s)
-                except QuotaExceeded as e:
-                    print(f"[WARN] {e}. Guardando progreso parcial…")
-                    raise StopRun()
-                if img or pdf:
-                    if need_img and img: df.at[i, COLS["img"]] = img
-                    if need_pdf and pdf: df.at[i, COLS["pdf"]] = pdf
-                    filled += 1
-                    status = "filled"; found_img, found_pdf = img, pdf
-                else:
-                    status = "no match"
-
-            rows.append({
-                "row": i+1, "cod_articulo_naves": cod_art, "ref_proveedor": ref,
-                "proveedor_raw": prov_raw, "brand_detected": brand or "",
+            w.writerow({
+                "row": start+j+1, "cod_articulo_naves": cod_a[j], "ref_proveedor": ref_a[j],
+                "proveedor_raw": prov_a[j], "brand_detected": brand_a[j],
                 "chosen_host": host or "", "search_pass": used_pass or "",
                 "product_page": page or "", "found_image": found_img or "",
                 "found_pdf": found_pdf or "", "status": status
             })
+        done += len(js)
+
+    try:
+        hits = from_sib = 0
+        for gk, js in groups.items():
+            brand, prov, ref, art = gk
+            j0 = js[0]
+            sib = (sib_img.get(gk, ""), sib_pdf.get(gk, ""))
+            # el grupo busca lo que le falte a cualquiera de sus filas y no tenga ya una hermana
+            need_img = bool(need_img_a[js].any()) and not sib[0]
+            need_pdf = bool(need_pdf_a[js].any()) and not sib[1]
+            if not (need_img or need_pdf):
+                record(js, (sib[0], sib[1], "", "", "sibling"), sib); from_sib += 1
+                continue
+            ckey = f"{brand}|{prov}|{ref}|{art}"
+            cached = enrich_cache.get(ckey)
+            # vale si da algo de lo que falta (lo mismo que devolvería una búsqueda nueva)
+            if cached and ((need_img and cached[0]) or (need_pdf and cached[1])):
+                record(js, with_sib(cached, sib), sib); hits += 1
+                continue
+            fut = ex.submit(try_enrich_with_hints, brand, ref_a[j0], art_a[j0], s, key, cx,
+                            need_img, need_pdf, args.max_queries_per_row)
+            pending[fut] = (ckey, js, sib)
+        if from_sib:
+            print(f"[INFO] Resueltas con URLs de filas del mismo producto: {from_sib} búsquedas")
+        if hits:
+            print(f"[INFO] Resueltas desde {args.enrich_cache}: {hits} búsquedas")
+
+        since_ckpt = 0
+        for fut in as_completed(pending):
+            ckey, js, sib = pending[fut]
+            recorded.add(fut)
+            try:
+                result = fut.result()
+            except QuotaExceeded as e:
+                print(f"[WARN] {e}. Guardando progreso parcial…")
+                break
+            except Exception as e:  # 400/403 de CSE, timeout tras reintentos…: falla el grupo, no el run
+                print(f"[WARN] Búsqueda fallida ({ref_a[js[0]] or art_a[js[0]]}): {e!r}")
+                w.writerows(skip_row(j, "error") for j in js)
+                done += len(js)
+                continue
+            if result[0] or result[1]:
+                enrich_cache[ckey] = list(result)
+            record(js, with_sib(result, sib), sib)
+            report_f.flush()  # una vez por búsqueda (segundos de red cada una): el informe va al día
+            since_ckpt += len(js)
+            if since_ckpt >= CHECKPOINT_EVERY:  # checkpoint: progreso recuperable aunque el job muera
+                since_ckpt = 0
+                apply_updates()
+                save_enrich_cache(enrich_cache, args.enrich_cache)
+                try:
+                    save_output(df, args.out, ckpt_fmt)
+                except Exception as e:  # arrow no serializa alguna columna: checkpoints en xlsx
+                    print(f"[WARN] Checkpoint {ckpt_fmt} falló ({e}); sigo con xlsx")
+                    ckpt_fmt = "xlsx"
+                    save_output(df, args.out, ckpt_fmt)
+                print(f"[INFO] Checkpoint: {done}/{n_todo} filas resueltas, {filled} con URLs")
 
-    except StopRun:
-        pass
     finally:
-        df.to_excel(args.out, index=False)
-        Path(args.report).parent.mkdir(parents=True, exist_ok=True)
-        if rows:
-            with open(args.report, "w", newline="", encoding="utf-8") as f:
-                w = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
-                w.writeheader(); w.writerows(rows)
+        # cuota agotada o error: no se lanza nada más; lo ya en vuelo termina y, como esas consultas
+        # ya se pagaron, sus resultados (y los terminados que as_completed no llegó a dar) se guardan
+        ex.shutdown(wait=True, cancel_futures=True)
+        for fut, (ckey, js, sib) in pending.items():
+            if fut in recorded or fut.cancelled() or not fut.done() or fut.exception() is not None:
+                continue
+            result = fut.result()
+            if result[0] or result[1]:
+                enrich_cache[ckey] = list(result)
+            record(js, with_sib(result, sib), sib)
+        report_f.close()
+        apply_updates()
+        save_enrich_cache(enrich_cache, args.enrich_cache)
+        save_output(df, args.out, args.out_format)
         print(f"[OK] Rows with URLs (filled): {filled}")
-        print(f"[OK] Outputs: {args.out} and {args.report}")
+        out = args.out if args.out_format == "xlsx" else Path(args.out).with_suffix(".parquet")
+        print(f"[OK] Outputs: {out} and {args.report}")
 
 if __name__ == "__main__":
     main()